@@ -0,0 +1,108 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+from prometheus_client import Counter, Histogram, Gauge
+
+INTERACTIVE = "interactive"
+PROPOSAL = "proposal"
+SUMMARY = "summary"
+
+PRIORITIES = {
+    INTERACTIVE: 0,
+    PROPOSAL: 1,
+    SUMMARY: 2,
+}
+queue_limits = {
+    INTERACTIVE: int(os.getenv('LLM_QUEUE_INTERACTIVE', '16')),
+    PROPOSAL: int(os.getenv('LLM_QUEUE_PROPOSAL', '8')),
+    SUMMARY: int(os.getenv('LLM_QUEUE_SUMMARY', '64')),
+}
+# how long a request may wait for a slot before it is dropped as stale
+max_waits = {
+    INTERACTIVE: float(os.getenv('LLM_MAX_WAIT_INTERACTIVE', '60')),
+    PROPOSAL: float(os.getenv('LLM_MAX_WAIT_PROPOSAL', '30')),
+    SUMMARY: float(os.getenv('LLM_MAX_WAIT_SUMMARY', '300')),
+}
+retry_after = int(os.getenv('LLM_RETRY_AFTER', '5'))
+
+LLM_QUEUE_DEPTH = Gauge('app_llm_queue_depth', 'LLM requests waiting for a slot', ['priority'], multiprocess_mode='livesum')
+LLM_QUEUE_WAIT = Histogram('app_llm_queue_wait_seconds', 'Time an LLM request waited for a slot', ['priority'])
+LLM_IN_FLIGHT = Gauge('app_llm_in_flight', 'LLM requests currently holding a slot', multiprocess_mode='livesum')
+LLM_REJECTED = Counter('app_llm_admission_rejected_total', 'LLM requests rejected or dropped before reaching the server', ['priority', 'reason'])
+
+class Overloaded(Exception):
+    def __init__(self, priority: str, reason: str):
+        super().__init__(f"LLM {priority} queue {reason}")
+        self.priority = priority
+        self.reason = reason
+        self.retry_after = retry_after
+
+class Dispatcher:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.active = 0
+        self.waiting = []
+        self.queued = {priority: 0 for priority in PRIORITIES}
+        self.sequence = itertools.count()
+
+    def full(self, priority: str):
+        return self.queued[priority] >= queue_limits[priority] and self.active >= self.concurrency
+
+    def check(self, priority: str):
+        if self.full(priority):
+            LLM_REJECTED.labels(priority=priority, reason="full").inc()
+            raise Overloaded(priority, "full")
+
+    async def acquire(self, priority: str):
+        start_time = time.time()
+        if self.active < self.concurrency and not any(self.queued.values()):
+            self.take(priority, start_time)
+            return
+        self.check(priority)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (PRIORITIES[priority], next(self.sequence), future))
+        self.queued[priority] += 1
+        LLM_QUEUE_DEPTH.labels(priority=priority).inc()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_waits[priority])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as we gave up
+                self.release()
+            future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                LLM_REJECTED.labels(priority=priority, reason="stale").inc()
+                raise Overloaded(priority, "stale")
+            raise
+        finally:
+            self.queued[priority] -= 1
+            LLM_QUEUE_DEPTH.labels(priority=priority).dec()
+        self.take(priority, start_time, False)
+
+    def take(self, priority: str, start_time: float, count: bool = True):
+        if count:
+            self.active += 1
+            LLM_IN_FLIGHT.inc()
+        LLM_QUEUE_WAIT.labels(priority=priority).observe(time.time() - start_time)
+
+    def release(self):
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                # the slot passes straight to the next waiter, active stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+        LLM_IN_FLIGHT.dec()
+
+    @asynccontextmanager
+    async def slot(self, priority: str):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
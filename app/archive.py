@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import gzip
+import os
+import time
+import uuid
+
+from bson import json_util
+from prometheus_client import Counter, Histogram
+from qdrant_client.http.models import PointStruct
+
+from .clients import redis, mongo, qdrant
+from .functions import mongodb_name, as_text
+from . import database, storage, vectors, summary, characters, turns
+
+archive_dir = os.getenv('ARCHIVE_DIR', '/archive')
+idle_days = float(os.getenv('ARCHIVE_IDLE_DAYS', '30'))
+archive_limit = int(os.getenv('ARCHIVE_LIMIT', '100'))
+failed_retry_days = float(os.getenv('ARCHIVE_FAILED_RETRY_DAYS', '7'))
+archive_interval = float(os.getenv('ARCHIVE_INTERVAL', '0'))
+batch_size = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))
+compression_level = int(os.getenv('ARCHIVE_COMPRESSION_LEVEL', '6'))
+restore_timeout = float(os.getenv('ARCHIVE_RESTORE_TIMEOUT', '60'))
+restore_poll_interval = float(os.getenv('ARCHIVE_RESTORE_POLL_INTERVAL', '0.25'))
+retry_after = int(os.getenv('ARCHIVE_RETRY_AFTER', '2'))
+grace_seconds = float(os.getenv('ARCHIVE_GRACE_SECONDS', '5'))
+
+# values of chat_users.mapping.archived
+HOT, COLD, ARCHIVING = 0, 1, 2
+
+ARCHIVE_CHATS = Counter('app_archive_chats_total', 'Chats moved between the hot stores and the archive', ['operation', 'status'])
+ARCHIVE_DURATION = Histogram('app_archive_duration_seconds', 'Time spent archiving or restoring a chat', ['operation'])
+ARCHIVE_BYTES = Histogram('app_archive_bytes', 'Compressed size of chat archives', buckets=[1e4, 1e5, 1e6, 1e7, 1e8, 1e9])
+
+class ChatRestoring(Exception):
+    def __init__(self):
+        super().__init__("Chat is being restored from the archive.")
+        self.retry_after = retry_after
+
+def archive_path(user_id: str, chat_id: str):
+    return os.path.join(archive_dir, user_id, f"{chat_id}.jsonl.gz")
+
+def redis_keys(user_id: str, chat_id: str):
+    return summary.summary_keys(user_id, chat_id) + [f"{user_id}-{chat_id}.world"]
+
+def point_sources(user_id: str, chat_id: str):
+    if vectors.is_shared():
+        return [(vectors.shared_collection, None)]
+    return [(vectors.collection_for(user_id, chat_id, kind), kind) for kind in (vectors.HISTORY, vectors.DOCUMENT)]
+
+def iter_points(user_id: str, chat_id: str):
+    for collection, kind in point_sources(user_id, chat_id):
+        if not qdrant.collection_exists(collection):
+            continue
+        offset = None
+        while True:
+            records, offset = qdrant.scroll(
+                collection,
+                scroll_filter=vectors.tenant_filter(user_id, chat_id) if vectors.is_shared() else None,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True,
+            )
+            for record in records:
+                yield {"kind": kind or record.payload.get("kind"), "id": record.id, "vector": record.vector, "payload": record.payload}
+            if offset is None:
+                break
+
+def iter_records(user_id: str, chat_id: str):
+    for creator, content, aid in storage.iter_messages_blocking(user_id, chat_id, batch_size=batch_size):
+        yield {"type": "message", "creator": creator, "content": content, "aid": aid}
+    for document_id, name, content in storage.iter_documents_blocking(user_id, chat_id, batch_size):
+        yield {"type": "document", "id": document_id, "name": name, "content": content}
+    for character in mongo[mongodb_name(user_id, chat_id)]['characters'].find(batch_size=batch_size):
+        yield {"type": "character", "document": character}
+    for key in redis_keys(user_id, chat_id):
+        value = redis.get(key)
+        if value is not None:
+            yield {"type": "redis", "key": key, "value": as_text(value)}
+    for point in iter_points(user_id, chat_id):
+        yield {"type": "point", **point}
+
+def export_blocking(user_id: str, chat_id: str):
+    path = archive_path(user_id, chat_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + ".partial"
+    try:
+        with open(partial, "wb") as raw:
+            with gzip.open(raw, "wt", encoding="utf-8", compresslevel=compression_level) as archive:
+                for record in iter_records(user_id, chat_id):
+                    archive.write(json_util.dumps(record) + "\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(partial, path)
+    except Exception:
+        remove_partial(user_id, chat_id)
+        raise
+    ARCHIVE_BYTES.observe(os.path.getsize(path))
+
+def remove_partial(user_id: str, chat_id: str):
+    if os.path.exists(archive_path(user_id, chat_id) + ".partial"):
+        os.remove(archive_path(user_id, chat_id) + ".partial")
+
+def free_blocking(user_id: str, chat_id: str):
+    mongo.drop_database(mongodb_name(user_id, chat_id))
+    vectors.delete_chat_blocking(user_id, chat_id)
+    if not vectors.is_shared() and qdrant.collection_exists(vectors.collection_for(user_id, chat_id, vectors.DOCUMENT)):
+        qdrant.delete_collection(vectors.collection_for(user_id, chat_id, vectors.DOCUMENT))
+    redis.delete(*redis_keys(user_id, chat_id))
+    characters.invalidate(user_id, chat_id)
+
+def flush(user_id: str, chat_id: str, kind: str, batch: list):
+    if not batch:
+        return
+    if kind == "message":
+        storage.restore_messages_blocking(user_id, chat_id, [(r["creator"], r["content"], r["aid"]) for r in batch])
+    elif kind == "document":
+        storage.restore_documents_blocking(user_id, chat_id, [(r["id"], r["name"], r["content"]) for r in batch])
+    elif kind == "character":
+        mongo[mongodb_name(user_id, chat_id)]['characters'].insert_many([r["document"] for r in batch])
+    elif kind == "redis":
+        redis.mset({r["key"]: r["value"] for r in batch})
+    elif kind == "point":
+        for point_kind in {r["kind"] for r in batch}:
+            vectors.upsert(
+                vectors.collection_for(user_id, chat_id, point_kind),
+                [PointStruct(id=r["id"], vector=r["vector"], payload=r["payload"]) for r in batch if r["kind"] == point_kind],
+            )
+    batch.clear()
+
+def import_blocking(user_id: str, chat_id: str):
+    # a restore interrupted half way is simply run again: rows and points are written idempotently
+    # and the character collection is rebuilt from scratch
+    mongo[mongodb_name(user_id, chat_id)].drop_collection('characters')
+    kind = None
+    batch = []
+    with gzip.open(archive_path(user_id, chat_id), "rt", encoding="utf-8") as archive:
+        for line in archive:
+            record = json_util.loads(line)
+            if record["type"] != kind or len(batch) >= batch_size:
+                flush(user_id, chat_id, kind, batch)
+                kind = record["type"]
+            batch.append(record)
+    flush(user_id, chat_id, kind, batch)
+    characters.invalidate(user_id, chat_id)
+
+async def archive_state(user_id: str, chat_id: str):
+    row = await database.fetch_one("SELECT archived FROM chat_users.mapping WHERE user_id=? AND chat_id=?;", [user_id, chat_id])
+    return row[0] if row else HOT
+
+async def set_state(user_id: str, chat_id: str, state: int):
+    await database.execute("UPDATE chat_users.mapping SET archived=? WHERE user_id=? AND chat_id=?;", [state, user_id, chat_id])
+
+async def is_archived(user_id: str, chat_id: str):
+    return await archive_state(user_id, chat_id) == COLD
+
+async def touch(user_id: str, chat_id: str):
+    await database.execute("UPDATE chat_users.mapping SET last_active=NOW() WHERE user_id=? AND chat_id=?;", [user_id, chat_id])
+
+async def locked(user_id: str, chat_id: str, operation: str, function):
+    # the turn lock keeps chat turns and other archive runs away while the chat moves between tiers
+    ticket = str(uuid.uuid4())
+    token, _ = await asyncio.to_thread(turns.try_acquire, user_id, chat_id, ticket)
+    if not token:
+        await asyncio.to_thread(turns.leave_queue, user_id, chat_id, ticket)
+        return False
+    keep_alive = asyncio.create_task(turns.keep_alive(user_id, chat_id, token))
+    start_time = time.time()
+    try:
+        await function()
+        ARCHIVE_CHATS.labels(operation=operation, status="ok").inc()
+        return True
+    except Exception:
+        ARCHIVE_CHATS.labels(operation=operation, status="error").inc()
+        raise
+    finally:
+        ARCHIVE_DURATION.labels(operation=operation).observe(time.time() - start_time)
+        keep_alive.cancel()
+        await asyncio.to_thread(turns.release, user_id, chat_id, token)
+
+async def archive_chat(user_id: str, chat_id: str):
+    async def run():
+        if await archive_state(user_id, chat_id) != HOT:
+            return
+        # new requests wait for the archive state to clear, requests that got past ensure_hot
+        # just before get the grace period to finish their writes
+        await set_state(user_id, chat_id, ARCHIVING)
+        await asyncio.sleep(grace_seconds)
+        try:
+            await asyncio.to_thread(export_blocking, user_id, chat_id)
+        except Exception:
+            await set_state(user_id, chat_id, HOT)
+            raise
+        # from here on the archive is the source of truth, a crash while freeing is repaired by the next restore
+        await database.execute("UPDATE chat_users.mapping SET archived=?, archive_failed_at=NULL WHERE user_id=? AND chat_id=?;", [COLD, user_id, chat_id])
+        await storage.delete_chat(user_id, chat_id)
+        await asyncio.to_thread(free_blocking, user_id, chat_id)
+    return await locked(user_id, chat_id, "archive", run)
+
+async def restore_chat(user_id: str, chat_id: str):
+    async def run():
+        state = await archive_state(user_id, chat_id)
+        if state == ARCHIVING:
+            # the archiver holds the lock for as long as the state is set, so it died half way
+            await asyncio.to_thread(remove_partial, user_id, chat_id)
+            await set_state(user_id, chat_id, HOT)
+            return
+        if state != COLD:
+            return
+        await storage.create_tables(user_id, chat_id)
+        await asyncio.to_thread(import_blocking, user_id, chat_id)
+        await database.execute("UPDATE chat_users.mapping SET archived=0, last_active=NOW() WHERE user_id=? AND chat_id=?;", [user_id, chat_id])
+        os.remove(archive_path(user_id, chat_id))
+    return await locked(user_id, chat_id, "restore", run)
+
+async def ensure_hot(user_id: str, chat_id: str):
+    start_time = time.time()
+    while await archive_state(user_id, chat_id) != HOT:
+        if await restore_chat(user_id, chat_id):
+            return
+        # another request or worker holds the chat, most likely archiving or restoring it
+        if time.time() - start_time > restore_timeout:
+            raise ChatRestoring()
+        await asyncio.sleep(restore_poll_interval)
+
+def delete(user_id: str, chat_id: str):
+    if os.path.exists(archive_path(user_id, chat_id)):
+        os.remove(archive_path(user_id, chat_id))
+
+async def archive_idle(days: float = idle_days, limit: int = archive_limit):
+    rows = await database.fetch_all(
+        "SELECT user_id, chat_id FROM chat_users.mapping WHERE archived=0 AND last_active < NOW() - INTERVAL ? SECOND"
+        " AND (archive_failed_at IS NULL OR archive_failed_at < NOW() - INTERVAL ? SECOND)"
+        " ORDER BY last_active LIMIT ?;",
+        [int(days * 86400), int(failed_retry_days * 86400), limit]
+    )
+    archived = 0
+    for user_id, chat_id in rows:
+        try:
+            if await archive_chat(user_id, chat_id):
+                archived += 1
+        except Exception as e:
+            # failed chats sit out for a while, otherwise they would fill every round's limit
+            print(f"archive {user_id}-{chat_id} failed: {e}")
+            await database.execute(
+                "UPDATE chat_users.mapping SET archive_failed_at=NOW() WHERE user_id=? AND chat_id=?;",
+                [user_id, chat_id]
+            )
+    print(f"archived {archived} of {len(rows)} idle chats")
+    return archived
+
+async def run_periodically():
+    # several worker replicas may run this loop, the lease lets one of them do each round
+    while True:
+        if await asyncio.to_thread(redis.set, "archive.lease", os.getpid(), nx=True, ex=max(1, int(archive_interval))):
+            try:
+                await archive_idle()
+            except Exception as e:
+                print(f"archive round failed: {e}")
+        await asyncio.sleep(archive_interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move chats that have been idle for a while into compressed archives.")
+    parser.add_argument("--idle-days", type=float, default=idle_days)
+    parser.add_argument("--limit", type=int, default=archive_limit)
+    args = parser.parse_args()
+    asyncio.run(archive_idle(args.idle_days, args.limit))
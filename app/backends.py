@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+from . import admission
+
+llm_model = os.getenv('LLM_MODEL')
+llm_url = os.getenv('LLM_URL', 'http://llama:8000')
+llm_timeout = float(os.getenv('LLM_TIMEOUT', '600'))
+llm_connect_timeout = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+llm_max_connections = int(os.getenv('LLM_MAX_CONNECTIONS', '32'))
+llm_slots = int(os.getenv('LLM_SLOTS', '0'))
+llm_concurrency = int(os.getenv('LLM_CONCURRENCY', '0'))
+app_workers = int(os.getenv('APP_WORKERS', '1'))
+eject_failures = int(os.getenv('LLM_EJECT_FAILURES', '3'))
+eject_seconds = float(os.getenv('LLM_EJECT_SECONDS', '30'))
+health_interval = float(os.getenv('LLM_HEALTH_INTERVAL', '10'))
+health_timeout = float(os.getenv('LLM_HEALTH_TIMEOUT', '2'))
+think_hold_chars = int(os.getenv('LLM_THINK_HOLD_CHARS', '0'))
+
+ROLES = list(admission.PRIORITIES)
+
+BACKEND_OUTSTANDING = Gauge('app_llm_backend_outstanding', 'LLM requests queued or running per backend', ['backend'], multiprocess_mode='livesum')
+BACKEND_HEALTHY = Gauge('app_llm_backend_healthy', 'Whether an LLM backend currently receives traffic', ['backend'], multiprocess_mode='livemin')
+BACKEND_EJECTIONS = Counter('app_llm_backend_ejections_total', 'LLM backends taken out of rotation', ['backend', 'reason'])
+BACKEND_REQUESTS = Counter('app_llm_backend_requests_total', 'LLM requests routed to a backend', ['backend', 'role'])
+
+class Backend:
+    def __init__(self, name: str, url: str, model: str, roles: list, slots: int, concurrency: int, think_hold: int = think_hold_chars):
+        self.name = name
+        self.model = model
+        self.roles = roles
+        self.slots = slots
+        # only for models whose chat template opens <think> itself, streaming then waits for </think>
+        self.think_hold = think_hold
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            headers={
+                "Content-Type": "application/json"
+            },
+            timeout=httpx.Timeout(llm_timeout, connect=llm_connect_timeout),
+            limits=httpx.Limits(
+                max_connections=llm_max_connections,
+                max_keepalive_connections=llm_max_connections,
+                keepalive_expiry=60,
+            ),
+        )
+        # every API worker process has its own dispatcher, so they split the backend's capacity
+        self.dispatcher = admission.Dispatcher(max(1, (concurrency or slots or 4) // app_workers))
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0
+        BACKEND_HEALTHY.labels(backend=name).set(1)
+
+    def healthy(self):
+        return time.time() >= self.ejected_until
+
+    def load(self):
+        return self.outstanding / self.dispatcher.concurrency
+
+    def eject(self, reason: str):
+        if self.healthy():
+            print(f"llm backend {self.name} ejected: {reason}")
+            BACKEND_EJECTIONS.labels(backend=self.name, reason=reason).inc()
+        self.ejected_until = time.time() + eject_seconds
+        BACKEND_HEALTHY.labels(backend=self.name).set(0)
+
+    def restore(self):
+        self.failures = 0
+        self.ejected_until = 0
+        BACKEND_HEALTHY.labels(backend=self.name).set(1)
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self, reason: str):
+        self.failures += 1
+        if self.failures >= eject_failures:
+            self.eject(reason)
+
+    def cache_options(self, cache_key: str | None):
+        if cache_key is None:
+            return {}
+        options = {"cache_prompt": True}
+        if self.slots > 0:
+            options["id_slot"] = zlib.crc32(cache_key.encode("utf-8")) % self.slots
+        return options
+
+    @asynccontextmanager
+    async def slot(self, role: str):
+        self.outstanding += 1
+        BACKEND_OUTSTANDING.labels(backend=self.name).inc()
+        BACKEND_REQUESTS.labels(backend=self.name, role=role).inc()
+        try:
+            async with self.dispatcher.slot(role):
+                yield
+        finally:
+            self.outstanding -= 1
+            BACKEND_OUTSTANDING.labels(backend=self.name).dec()
+
+def load_backends():
+    config = os.getenv('LLM_BACKENDS')
+    if not config:
+        return [Backend("default", llm_url, llm_model, ROLES, llm_slots, llm_concurrency)]
+    return [
+        Backend(
+            entry.get("name", entry["url"]),
+            entry["url"],
+            entry.get("model", llm_model),
+            entry.get("roles", ROLES),
+            int(entry.get("slots", llm_slots)),
+            int(entry.get("concurrency", llm_concurrency)),
+            int(entry.get("think_hold", think_hold_chars)),
+        )
+        for entry in json.loads(config)
+    ]
+
+registry = load_backends()
+health_task = None
+
+def candidates(role: str):
+    tagged = [backend for backend in registry if role in backend.roles] or registry
+    return [backend for backend in tagged if backend.healthy()] or tagged
+
+def pick(role: str, cache_key: str | None = None):
+    # least outstanding requests relative to capacity; ties go to the backend the cache key hashes to,
+    # so an idle chat keeps hitting the server that holds its cached prompt prefix
+    options = candidates(role)
+    offset = zlib.crc32(cache_key.encode("utf-8")) % len(options) if cache_key else 0
+    return min(options[offset:] + options[:offset], key=Backend.load)
+
+def check(role: str):
+    options = candidates(role)
+    if all(backend.dispatcher.full(role) for backend in options):
+        options[0].dispatcher.check(role)
+
+async def check_health(backend: Backend):
+    try:
+        response = await backend.client.get("/health", timeout=health_timeout)
+    except httpx.HTTPError:
+        backend.eject("health")
+        return
+    if response.status_code == 200:
+        backend.restore()
+    else:
+        backend.eject("health")
+
+async def health_checks():
+    while True:
+        await asyncio.gather(*[check_health(backend) for backend in registry])
+        await asyncio.sleep(health_interval)
+
+def start_health_checks():
+    global health_task
+    if health_task is None and health_interval > 0:
+        health_task = asyncio.create_task(health_checks())
+
+async def close():
+    if health_task is not None:
+        health_task.cancel()
+    for backend in registry:
+        await backend.client.aclose()
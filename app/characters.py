@@ -0,0 +1,31 @@
+import json
+
+from bson import json_util
+from prometheus_client import Counter
+
+from .clients import redis, mongo
+from .functions import mongodb_name
+
+CHARACTER_CACHE_REQUESTS = Counter('app_character_cache_requests_total', 'Character sheet render cache lookups', ['result'])
+
+def cache_key(user_id: str, chat_id: str):
+    return f"{user_id}-{chat_id}.characters_rendered"
+
+def render(characters: list):
+    return json.dumps(characters, default=json_util.default, separators=(",", ":"))
+
+def rebuild(user_id: str, chat_id: str):
+    rendered = render(list(mongo[mongodb_name(user_id, chat_id)]['characters'].find()))
+    redis.set(cache_key(user_id, chat_id), rendered)
+    return rendered
+
+def get_rendered(user_id: str, chat_id: str):
+    cached = redis.get(cache_key(user_id, chat_id))
+    if cached is not None:
+        CHARACTER_CACHE_REQUESTS.labels(result="hit").inc()
+        return cached.decode("utf-8") if isinstance(cached, bytes) else cached
+    CHARACTER_CACHE_REQUESTS.labels(result="miss").inc()
+    return rebuild(user_id, chat_id)
+
+def invalidate(user_id: str, chat_id: str):
+    redis.delete(cache_key(user_id, chat_id))
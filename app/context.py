@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import time
+
+import mariadb
+from prometheus_client import Histogram
+
+from .clients import redis
+from . import storage, characters, vectors, retrieval
+from .functions import as_text
+
+source_timeout = float(os.getenv('CONTEXT_SOURCE_TIMEOUT', '2'))
+recent_message_count = int(os.getenv('CONTEXT_RECENT_MESSAGES', '20'))
+
+CONTEXT_STAGE_DURATION = Histogram(
+    'app_context_stage_duration_seconds',
+    'Time spent fetching one source during chat context assembly',
+    ['source', 'status']
+)
+CONTEXT_DURATION = Histogram('app_context_duration_seconds', 'Total time spent on chat context assembly')
+
+async def timed(source: str, awaitable, fallback, timeout: float = source_timeout):
+    start_time = time.time()
+    status = "ok"
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        status = "timeout"
+        print(f"context source {source} timed out after {timeout}s")
+        return fallback
+    except mariadb.Error:
+        status = "error"
+        raise
+    except Exception as e:
+        status = "error"
+        print(f"context source {source}: {e}")
+        return fallback
+    finally:
+        CONTEXT_STAGE_DURATION.labels(source=source, status=status).observe(time.time() - start_time)
+
+def fetch_redis(user_id: str, chat_id: str):
+    long_term, medium_term, short_term, world = redis.mget([
+        f"{user_id}-{chat_id}.long_text_summary",
+        f"{user_id}-{chat_id}.medium_text_summary",
+        f"{user_id}-{chat_id}.short_text_summary",
+        f"{user_id}-{chat_id}.world",
+    ])
+    return {
+        "long_term_summary": as_text(long_term),
+        "medium_term_summary": as_text(medium_term),
+        "short_term_summary": as_text(short_term),
+        "world": ", ".join(json.loads(world or "[]")),
+    }
+
+def fetch_redis_fallback():
+    return {
+        "long_term_summary": "",
+        "medium_term_summary": "",
+        "short_term_summary": "",
+        "world": "",
+    }
+
+async def fetch_vectors(user_id: str, chat_id: str, query_text: str, old_messages: list):
+    points = await vectors.search(
+        user_id,
+        chat_id,
+        query_text,
+        retrieval.candidate_count,
+        retrieval.score_threshold,
+        True
+    )
+    return retrieval.select(points, old_messages)
+
+async def fetch_history_and_vectors(user_id: str, chat_id: str, description: str):
+    # the vector query needs the previous response, so it starts as soon as
+    # MariaDB answers instead of waiting for every other source
+    old_messages = await timed("mariadb", storage.recent_messages(user_id, chat_id, recent_message_count), [])
+    previous_response = old_messages[-1][1] if old_messages else ""
+    vectordb_results = await timed(
+        "qdrant",
+        fetch_vectors(user_id, chat_id, previous_response + "\n" + description, old_messages),
+        []
+    )
+    return old_messages, previous_response, vectordb_results
+
+async def assemble_context(user_id: str, chat_id: str, description: str):
+    start_time = time.time()
+    cached, rendered_characters, (old_messages, previous_response, vectordb_results) = await asyncio.gather(
+        timed("redis", asyncio.to_thread(fetch_redis, user_id, chat_id), fetch_redis_fallback()),
+        timed("mongo", asyncio.to_thread(characters.get_rendered, user_id, chat_id), "[]"),
+        fetch_history_and_vectors(user_id, chat_id, description),
+    )
+    CONTEXT_DURATION.observe(time.time() - start_time)
+    return {
+        **cached,
+        "characters": rendered_characters,
+        "old_messages": old_messages,
+        "previous_response": previous_response,
+        "vectordb_results": vectordb_results,
+    }
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import mariadb
+from prometheus_client import Counter, Histogram, Gauge
+
+pool_size = int(os.getenv('MARIADB_POOL_SIZE', '10'))
+checkout_timeout = float(os.getenv('MARIADB_CHECKOUT_TIMEOUT', '10'))
+
+pool = None
+pool_lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="mariadb")
+
+POOL_SIZE = Gauge('app_db_pool_size', 'MariaDB connection pool size', multiprocess_mode='livesum')
+POOL_IN_USE = Gauge('app_db_pool_connections_in_use', 'MariaDB connections checked out of the pool', multiprocess_mode='livesum')
+POOL_CHECKOUT_WAIT = Histogram('app_db_pool_checkout_seconds', 'Time spent waiting for a MariaDB connection')
+POOL_CHECKOUT_FAILURES = Counter('app_db_pool_checkout_failures_total', 'MariaDB connection checkouts that failed', ['reason'])
+POOL_SIZE.set(pool_size)
+
+def get_pool():
+    # created on first use instead of at import, so importing the app does not need a reachable database
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = mariadb.ConnectionPool(
+                pool_name="app",
+                pool_size=pool_size,
+                pool_reset_connection=False,
+                pool_validation_interval=int(os.getenv('MARIADB_VALIDATION_INTERVAL_MS', '1000')),
+                user=os.getenv('MARIADB_USER', 'root'),
+                password=os.getenv('MARIADB_PASSWORD', 'example'),
+                host=os.getenv('MARIADB_HOST', 'mariadb'),
+                port=int(os.getenv('MARIADB_PORT', '3306')),
+                autocommit=True,
+            )
+    return pool
+
+def reset_after_fork():
+    # connections and executor threads of the parent must not be used by a forked worker
+    global pool, pool_lock, executor
+    pool = None
+    pool_lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="mariadb")
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+def checkout():
+    start_time = time.time()
+    while True:
+        try:
+            connection = get_pool().get_connection()
+        except mariadb.PoolError:
+            connection = None
+        if connection is not None:
+            break
+        if time.time() - start_time > checkout_timeout:
+            POOL_CHECKOUT_FAILURES.labels(reason="timeout").inc()
+            raise mariadb.PoolError("No MariaDB connection available in pool")
+        time.sleep(0.01)
+    try:
+        connection.ping()
+    except mariadb.Error:
+        POOL_CHECKOUT_FAILURES.labels(reason="unhealthy").inc()
+        connection.reconnect()
+    POOL_CHECKOUT_WAIT.observe(time.time() - start_time)
+    return connection
+
+@contextmanager
+def connection():
+    conn = checkout()
+    POOL_IN_USE.inc()
+    try:
+        yield conn
+    finally:
+        POOL_IN_USE.dec()
+        conn.close()
+
+def execute_blocking(query: str, parameters: list | tuple = ()):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, parameters)
+        return cursor.rowcount
+
+def fetch_all_blocking(query: str, parameters: list | tuple = ()):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, parameters)
+        return cursor.fetchall()
+
+def fetch_one_blocking(query: str, parameters: list | tuple = ()):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, parameters)
+        return cursor.fetchone()
+
+async def run(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+async def execute(query: str, parameters: list | tuple = ()):
+    return await run(execute_blocking, query, parameters)
+
+async def fetch_all(query: str, parameters: list | tuple = ()):
+    return await run(fetch_all_blocking, query, parameters)
+
+async def fetch_one(query: str, parameters: list | tuple = ()):
+    return await run(fetch_one_blocking, query, parameters)
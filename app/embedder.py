@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI
+from fastembed import TextEmbedding
+from prometheus_client import Histogram, make_asgi_app
+from pydantic import BaseModel
+
+embed_model = os.getenv('EMBED_MODEL', 'BAAI/bge-small-en')
+embed_threads = int(os.getenv('EMBED_THREADS', '2'))
+max_batch_size = int(os.getenv('EMBED_MAX_BATCH', '64'))
+batch_window = float(os.getenv('EMBED_BATCH_WINDOW_MS', '10')) / 1000
+
+EMBED_BATCH_SIZE = Histogram(
+    'app_embed_batch_size',
+    'Texts embedded per batch',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+EMBED_BATCH_DURATION = Histogram('app_embed_batch_duration_seconds', 'Time spent computing one embedding batch')
+EMBED_REQUEST_DURATION = Histogram('app_embed_request_duration_seconds', 'Time from receiving an embedding request until it was answered')
+
+class EmbedRequest(BaseModel):
+    texts: list[str]
+
+class MicroBatcher:
+    def __init__(self, model: TextEmbedding):
+        self.model = model
+        self.queue = asyncio.Queue()
+        # ONNX runs its own intra-op threads, a single caller thread keeps batches serialized
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+
+    async def submit(self, texts: list):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future))
+        return await future
+
+    def embed(self, texts: list):
+        return [vector.tolist() for vector in self.model.embed(texts, batch_size=len(texts))]
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + batch_window
+        while size < max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            texts = [text for item in batch for text in item[0]]
+            start_time = time.time()
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.embed, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            EMBED_BATCH_SIZE.observe(len(texts))
+            EMBED_BATCH_DURATION.observe(time.time() - start_time)
+            offset = 0
+            for item_texts, future in batch:
+                # the submitter may have been cancelled while the batch ran
+                if not future.done():
+                    future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+batcher = MicroBatcher(TextEmbedding(embed_model, threads=embed_threads, providers=["CPUExecutionProvider"]))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(batcher.run())
+    yield
+    task.cancel()
+
+app = FastAPI(title="Gamemaster AI Embedder", lifespan=lifespan)
+app.mount("/metrics/", make_asgi_app())
+
+@app.get('/')
+async def root():
+    return 'OK'
+
+@app.post('/embed')
+async def embed(request: EmbedRequest):
+    start_time = time.time()
+    vectors = await batcher.submit(request.texts) if request.texts else []
+    EMBED_REQUEST_DURATION.observe(time.time() - start_time)
+    return {"vectors": vectors}
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv('EMBEDDER_PORT', '8001')))
@@ -0,0 +1,19 @@
+import os
+
+import httpx
+
+embedder_url = os.getenv('EMBEDDER_URL', 'http://embedder:8001')
+
+client = httpx.AsyncClient(
+    base_url=embedder_url,
+    timeout=httpx.Timeout(float(os.getenv('EMBEDDER_TIMEOUT', '30')), connect=5),
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
+
+async def embed(texts: list):
+    response = await client.post("/embed", json={"texts": texts})
+    response.raise_for_status()
+    return response.json()["vectors"]
+
+async def close():
+    await client.aclose()
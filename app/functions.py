@@ -1,26 +1,47 @@
 import os
 import uuid
 import json
-from qdrant_client.http.models import QueryResponse
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from qdrant_client.http.models import ScoredPoint
 from bson.objectid import ObjectId
 from enum import StrEnum
 from pydantic import BaseModel
-from bson import json_util
 from datetime import datetime, UTC, timedelta
-from jwt import encode, decode
+from jwt import encode, decode, get_unverified_header
 
 with open('./app/character-sheet.schema.json', 'r') as schema_file:
     schema = json.dumps(json.load(schema_file))
 with open('./app/rsa_private_key.pem', 'rb') as rsa_private_key_file:
-    signing_key = rsa_private_key_file.read()
+    signing_keys = {"RS256": rsa_private_key_file.read()}
 with open('./app/rsa_public_key.pem', 'rb') as rsa_public_key_file:
-    verifying_key = rsa_public_key_file.read()
+    verifying_keys = {"RS256": rsa_public_key_file.read()}
+if os.path.exists('./app/ed25519_private_key.pem'):
+    with open('./app/ed25519_private_key.pem', 'rb') as ed25519_private_key_file:
+        signing_keys["EdDSA"] = ed25519_private_key_file.read()
+if os.path.exists('./app/ed25519_public_key.pem'):
+    with open('./app/ed25519_public_key.pem', 'rb') as ed25519_public_key_file:
+        verifying_keys["EdDSA"] = ed25519_public_key_file.read()
 with open('./app/rules.md', 'r') as md_file:
     rules = md_file.read()
 
+jwt_algorithm = os.getenv('JWT_ALGORITHM', 'RS256')
+if jwt_algorithm not in signing_keys:
+    # fail at startup instead of on the first login or registration
+    raise RuntimeError(f"JWT_ALGORITHM {jwt_algorithm} has no signing key in ./app")
+jwt_cache_size = int(os.getenv('JWT_CACHE_SIZE', '10000'))
+jwt_cache_ttl = float(os.getenv('JWT_CACHE_TTL', '300'))
+jwt_cache = OrderedDict()
+jwt_cache_lock = threading.Lock()
+
 def get_rules():
     return rules
 
+def get_schema():
+    return schema
+
 def mariadb_name(user_id: str, chat_id: str):
     # max length 64
     return f"{user_id}{chat_id}".replace("-", "")
@@ -29,8 +50,13 @@ def mongodb_name(user_id: str, chat_id: str):
     # max length 63
     return f"{user_id}{chat_id}".replace("-", "")[:-1]
 
-def simplify_result(query_result: QueryResponse):
-    return query_result.model_dump(mode="json")
+def simplify_result(query_result: ScoredPoint):
+    return (query_result.payload or {}).get("document", "")
+
+def as_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value or ""
 
 def is_uuid_like(string: str):
     if string is None:
@@ -54,30 +80,43 @@ def to_mongo_compatible(obj: BaseModel, object_id: str | None = None):
         dc["_id"] = ObjectId(object_id)
     return dc
 
-def get_system_prompt(characters, world: str, short_term_summary: str, medium_term_summary: str, long_term_summary: str, vectordb_results):
-    out = ""
-    if len(characters) >= 1:
-        out += "# Player Characters:\nThe following character sheets are for reference ONLY."\
-            " Do not use these to infer motivations or write actions for player characters."\
-            "\n```json\n" + json.dumps(characters, default=json_util.default) + "\n```\n"\
-            "## Character Sheet Schema:\n```json\n" + schema + "\n```\n"
-    if len(world) > 0:
-        out += "# World:\n" + ", ".join(world) + "\n"
-    if short_term_summary != "":
-        out += "# Short Term Summary:\n" + short_term_summary +"\n"
-    if medium_term_summary != "":
-        out += "# Medium Term Summary:\n" + medium_term_summary +"\n"
-    if long_term_summary != "":
-        out += "# Long Term Summary:\n" + long_term_summary +"\n"
-    if len(vectordb_results) > 0:
-        out += "# Potentially Related Information:\n```json\n" + json.dumps(vectordb_results) + "\n```"
-    return out.strip()
+def cached_user_id(digest: bytes):
+    now = time.time()
+    with jwt_cache_lock:
+        entry = jwt_cache.get(digest)
+        if entry is None:
+            return None
+        user_id, not_before, expires = entry
+        if now < not_before or now >= expires:
+            if now >= expires:
+                del jwt_cache[digest]
+            return None
+        jwt_cache.move_to_end(digest)
+        return user_id
+
+def cache_user_id(digest: bytes, user_id: str, payload: dict):
+    expires = min(payload.get("exp", float("inf")), time.time() + jwt_cache_ttl)
+    with jwt_cache_lock:
+        jwt_cache[digest] = (user_id, payload.get("nbf", 0), expires)
+        jwt_cache.move_to_end(digest)
+        while len(jwt_cache) > jwt_cache_size:
+            jwt_cache.popitem(last=False)
 
 def user_id_from_jwt(encoded_jwt: str):
+    if not encoded_jwt:
+        return None
+    digest = hashlib.sha256(encoded_jwt.encode("utf-8")).digest()
+    user_id = cached_user_id(digest)
+    if user_id is not None:
+        return user_id
     try:
-        payload = decode(encoded_jwt, verifying_key, algorithms=["RS256"])
+        algorithm = get_unverified_header(encoded_jwt).get("alg")
+        if algorithm not in verifying_keys:
+            return None
+        payload = decode(encoded_jwt, verifying_keys[algorithm], algorithms=[algorithm])
         if payload['iss'] != os.getenv("UI_HOST", "http://localhost"):
             return None
+        cache_user_id(digest, payload["sub"], payload)
         return payload["sub"]
     except Exception as e:
         print(f"jwt unpacking: {e}")
@@ -91,6 +130,6 @@ def user_id_to_jwt(user_id: str):
             'exp': datetime.now(UTC) + timedelta(days=360),
             'nbf': datetime.now(UTC),
         },
-        signing_key,
-        algorithm='RS256'
+        signing_keys[jwt_algorithm],
+        algorithm=jwt_algorithm
     )
\ No newline at end of file
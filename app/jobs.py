@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+import zlib
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import ResponseError
+from prometheus_client import Counter, Histogram, Gauge
+
+job_shards = int(os.getenv('JOB_SHARDS', '8'))
+max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+retry_backoff = float(os.getenv('JOB_RETRY_BACKOFF', '1'))
+lease_ttl_ms = int(os.getenv('JOB_LEASE_TTL_MS', '30000'))
+done_ttl = int(os.getenv('JOB_DONE_TTL', str(60 * 60 * 24)))
+
+STREAM_PREFIX = "jobs"
+GROUP = "workers"
+DEAD_LETTER_STREAM = "jobs:dead"
+# job types with streams of their own: LLM-bound work must not hold up the ordered history
+# writes and lock releases of every chat hashed to the same shard
+SEPARATE_LANES = ["summary"]
+LANES = [""] + SEPARATE_LANES
+
+JOB_ENQUEUED = Counter('app_job_enqueued_total', 'Background jobs enqueued', ['type'])
+JOB_PROCESSED = Counter('app_job_processed_total', 'Background jobs processed', ['type', 'status'])
+JOB_LATENCY = Histogram('app_job_latency_seconds', 'Time from enqueueing a background job until it finished', ['type'])
+JOB_LAG = Histogram('app_job_lag_seconds', 'Time a background job waited in the queue before its first attempt', ['type'])
+JOB_DURATION = Histogram('app_job_duration_seconds', 'Time spent running a background job handler', ['type'])
+JOB_QUEUE_DEPTH = Gauge('app_job_queue_depth', 'Background jobs waiting in a queue shard', ['shard'], multiprocess_mode='livemax')
+
+RENEW_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+HANDLERS = {}
+
+def handler(job_type: str):
+    def register(function):
+        HANDLERS[job_type] = function
+        return function
+    return register
+
+def shard_for(user_id: str, chat_id: str):
+    return zlib.crc32(f"{user_id}-{chat_id}".encode("utf-8")) % job_shards
+
+def lane_for(job_type: str):
+    return job_type if job_type in SEPARATE_LANES else ""
+
+def stream_name(shard: int, lane: str = ""):
+    if lane:
+        return f"{STREAM_PREFIX}:{lane}:{shard}"
+    return f"{STREAM_PREFIX}:{shard}"
+
+def lease_key(stream: str):
+    return "jobs:lease:" + stream.removeprefix(STREAM_PREFIX + ":")
+
+def enqueue(redis: Redis, job_type: str, user_id: str, chat_id: str, **payload):
+    job_id = str(uuid.uuid4())
+    redis.xadd(stream_name(shard_for(user_id, chat_id), lane_for(job_type)), {
+        "id": job_id,
+        "type": job_type,
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "payload": json.dumps(payload),
+        "enqueued_at": str(time.time()),
+    })
+    JOB_ENQUEUED.labels(type=job_type).inc()
+    return job_id
+
+async def run_job(redis: AsyncRedis, fields: dict):
+    job_type = fields["type"]
+    done_key = f"jobs:done:{fields['id']}"
+    if await redis.exists(done_key):
+        JOB_PROCESSED.labels(type=job_type, status="duplicate").inc()
+        return
+    job_handler = HANDLERS.get(job_type)
+    if job_handler is None:
+        await redis.xadd(DEAD_LETTER_STREAM, {**fields, "error": "unknown job type"})
+        JOB_PROCESSED.labels(type=job_type, status="dead").inc()
+        return
+    JOB_LAG.labels(type=job_type).observe(time.time() - float(fields["enqueued_at"]))
+    payload = json.loads(fields["payload"])
+    for attempt in range(max_attempts):
+        start_time = time.time()
+        try:
+            await job_handler(fields["id"], fields["user_id"], fields["chat_id"], **payload)
+        except Exception as e:
+            JOB_DURATION.labels(type=job_type).observe(time.time() - start_time)
+            print(f"job {fields['id']} ({job_type}) attempt {attempt + 1} failed: {e}")
+            if attempt + 1 >= max_attempts:
+                await redis.xadd(DEAD_LETTER_STREAM, {**fields, "error": f"{e}"})
+                JOB_PROCESSED.labels(type=job_type, status="dead").inc()
+                return
+            JOB_PROCESSED.labels(type=job_type, status="retry").inc()
+            await asyncio.sleep(retry_backoff * (2 ** attempt))
+            continue
+        JOB_DURATION.labels(type=job_type).observe(time.time() - start_time)
+        JOB_LATENCY.labels(type=job_type).observe(time.time() - float(fields["enqueued_at"]))
+        JOB_PROCESSED.labels(type=job_type, status="success").inc()
+        await redis.set(done_key, "1", ex=done_ttl)
+        return
+
+async def ensure_group(redis: AsyncRedis, stream: str):
+    try:
+        await redis.xgroup_create(stream, GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in f"{e}":
+            raise
+
+async def acquire_lease(redis: AsyncRedis, stream: str, worker_id: str):
+    if await redis.set(lease_key(stream), worker_id, nx=True, px=lease_ttl_ms):
+        return True
+    return await renew_lease(redis, stream, worker_id)
+
+async def renew_lease(redis: AsyncRedis, stream: str, worker_id: str):
+    return await redis.eval(RENEW_LEASE, 1, lease_key(stream), worker_id, lease_ttl_ms) == 1
+
+async def keep_lease(redis: AsyncRedis, stream: str, worker_id: str, lost: asyncio.Event):
+    while await renew_lease(redis, stream, worker_id):
+        await asyncio.sleep(lease_ttl_ms / 3000)
+    lost.set()
+
+async def consume_shard(redis: AsyncRedis, shard: int, lane: str, worker_id: str):
+    # The consumer name is bound to the shard, not the worker: whichever worker
+    # holds the lease picks up entries a crashed predecessor left unacknowledged.
+    stream = stream_name(shard, lane)
+    consumer = f"shard-{shard}"
+    lost = asyncio.Event()
+    heartbeat = asyncio.create_task(keep_lease(redis, stream, worker_id, lost))
+    try:
+        await ensure_group(redis, stream)
+        last_id = "0"
+        while not lost.is_set():
+            entries = await redis.xreadgroup(GROUP, consumer, {stream: last_id}, count=10, block=1000)
+            messages = entries[0][1] if entries else []
+            if last_id == "0" and not messages:
+                last_id = ">"
+                continue
+            for entry_id, fields in messages:
+                if lost.is_set():
+                    return
+                await run_job(redis, fields)
+                await redis.xack(stream, GROUP, entry_id)
+                await redis.xdel(stream, entry_id)
+            JOB_QUEUE_DEPTH.labels(shard=stream.removeprefix(STREAM_PREFIX + ":")).set(await redis.xlen(stream))
+    except Exception as e:
+        print(f"job stream {stream}: {e}")
+    finally:
+        heartbeat.cancel()
+
+async def run_worker(redis: AsyncRedis):
+    worker_id = str(uuid.uuid4())
+    tasks = {}
+    while True:
+        for lane in LANES:
+            for shard in range(job_shards):
+                if (lane, shard) in tasks and not tasks[lane, shard].done():
+                    continue
+                if await acquire_lease(redis, stream_name(shard, lane), worker_id):
+                    tasks[lane, shard] = asyncio.create_task(consume_shard(redis, shard, lane, worker_id))
+        await asyncio.sleep(lease_ttl_ms / 3000)
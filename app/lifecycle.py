@@ -0,0 +1,141 @@
+import asyncio
+import os
+import time
+
+from prometheus_client import Gauge, CollectorRegistry, REGISTRY, multiprocess
+
+from .clients import redis, mongo, qdrant
+from . import database, storage, vectors, embedding, backends
+
+startup_timeout = float(os.getenv('STARTUP_TIMEOUT', '120'))
+startup_retry_interval = float(os.getenv('STARTUP_RETRY_INTERVAL', '2'))
+ready_timeout = float(os.getenv('READY_TIMEOUT', '2'))
+multiprocess_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+ready_required = [name for name in os.getenv('READY_REQUIRED', 'mariadb,redis,mongo,qdrant').split(',') if name]
+
+STARTUP_PHASE_SECONDS = Gauge('app_startup_phase_seconds', 'Time spent in each startup phase', ['phase'], multiprocess_mode='max')
+
+phases = {}
+started = False
+
+def setup_mariadb():
+    database.execute_blocking("CREATE DATABASE IF NOT EXISTS `chat_users`;")
+    database.execute_blocking("CREATE TABLE IF NOT EXISTS chat_users.mapping"
+                              " (user_id char(36),chat_id char(36), chat_name varchar(255), PRIMARY KEY(user_id, chat_id))"
+                              " charset=utf8;")
+    database.execute_blocking("CREATE TABLE IF NOT EXISTS chat_users.applied_jobs"
+                              " (job_id char(36) NOT NULL, aid BIGINT, created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+                              " PRIMARY KEY(job_id), KEY(created_at)) charset=utf8;")
+    database.execute_blocking("ALTER TABLE chat_users.mapping"
+                              " ADD COLUMN IF NOT EXISTS last_active TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+                              " ADD COLUMN IF NOT EXISTS archived tinyint(1) NOT NULL DEFAULT 0,"
+                              " ADD COLUMN IF NOT EXISTS archive_failed_at TIMESTAMP NULL DEFAULT NULL,"
+                              " ADD INDEX IF NOT EXISTS idle (archived, last_active);")
+    database.execute_blocking("CREATE TABLE IF NOT EXISTS chat_users.users"
+                              " (aid BIGINT AUTO_INCREMENT NOT NULL, user_id char(36), user_name varchar(255), password varchar(255), active tinyint(1), PRIMARY KEY(aid), UNIQUE (user_id))"
+                              " charset=utf8;")
+    if storage.is_shared():
+        storage.setup_blocking()
+
+def setup_qdrant():
+    if vectors.is_shared():
+        vectors.setup_blocking()
+    else:
+        qdrant.get_collections()
+
+async def warm_llm():
+    await asyncio.gather(*[backends.check_health(backend) for backend in backends.registry])
+    backends.start_health_checks()
+    healthy = [backend.name for backend in backends.registry if backend.healthy()]
+    if not healthy:
+        raise RuntimeError("no healthy LLM backend")
+
+async def phase(name: str, function, required: bool):
+    start_time = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await function()
+            error = None
+            break
+        except Exception as e:
+            error = f"{e}"
+            if not required or time.time() - start_time > startup_timeout:
+                break
+            print(f"startup {name} attempt {attempt} failed: {e}")
+            await asyncio.sleep(startup_retry_interval)
+    duration = time.time() - start_time
+    phases[name] = {"seconds": round(duration, 3), "ok": error is None, "attempts": attempt}
+    if error:
+        phases[name]["error"] = error
+    STARTUP_PHASE_SECONDS.labels(phase=name).set(duration)
+    print(f"startup {name} {'ok' if error is None else 'failed: ' + error} after {duration:.3f}s")
+    if error and required:
+        raise RuntimeError(f"startup {name} failed: {error}")
+
+async def startup():
+    global started
+    start_time = time.time()
+    # the schema has to exist before requests are served, the rest only warms caches and connections
+    await asyncio.gather(
+        phase("mariadb", lambda: database.run(setup_mariadb), True),
+        phase("redis", lambda: asyncio.to_thread(redis.ping), False),
+        phase("mongo", lambda: asyncio.to_thread(mongo.admin.command, "ping"), False),
+        phase("qdrant", lambda: asyncio.to_thread(setup_qdrant), vectors.is_shared()),
+        phase("embedder", lambda: embedding.embed(["warmup"]), False),
+        phase("llm", warm_llm, False),
+    )
+    started = True
+    print(f"startup finished after {time.time() - start_time:.3f}s")
+
+async def shutdown():
+    await backends.close()
+    await embedding.close()
+    if multiprocess_dir:
+        multiprocess.mark_process_dead(os.getpid())
+
+def metrics_registry():
+    # with several uvicorn workers every process writes its samples to PROMETHEUS_MULTIPROC_DIR
+    # and /metrics/ aggregates them, whichever worker answers the scrape
+    if not multiprocess_dir:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+async def embedder_ready():
+    response = await embedding.client.get("/")
+    response.raise_for_status()
+
+async def llm_ready():
+    if not any(backend.healthy() for backend in backends.registry):
+        raise RuntimeError("no healthy LLM backend")
+
+CHECKS = {
+    "mariadb": lambda: database.fetch_one("SELECT 1"),
+    "redis": lambda: asyncio.to_thread(redis.ping),
+    "mongo": lambda: asyncio.to_thread(mongo.admin.command, "ping"),
+    "qdrant": lambda: asyncio.to_thread(qdrant.get_collections),
+    "embedder": embedder_ready,
+    "llm": llm_ready,
+}
+
+async def check(name: str):
+    start_time = time.time()
+    try:
+        await asyncio.wait_for(CHECKS[name](), ready_timeout)
+        status = {"ok": True}
+    except asyncio.TimeoutError:
+        status = {"ok": False, "error": "timeout"}
+    except Exception as e:
+        status = {"ok": False, "error": f"{e}"}
+    status["seconds"] = round(time.time() - start_time, 3)
+    return name, status
+
+async def readiness():
+    if not started:
+        return False, {"startup": phases}
+    results = dict(await asyncio.gather(*[check(name) for name in CHECKS]))
+    ready = all(results[name]["ok"] for name in ready_required if name in results)
+    return ready, {"dependencies": results, "startup": phases}
@@ -0,0 +1,290 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from prometheus_client import Counter, Histogram
+from starlette.requests import Request
+
+from . import admission, backends
+
+llm_retries = int(os.getenv('LLM_RETRIES', '3'))
+llm_backoff = float(os.getenv('LLM_BACKOFF', '0.5'))
+tokenize_timeout = float(os.getenv('LLM_TOKENIZE_TIMEOUT', '2'))
+
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+LLM_PROMPT_TOKENS = Counter('app_llm_prompt_tokens_total', 'Prompt tokens reported by the LLM server', ['source'])
+LLM_PROMPT_SECONDS = Histogram('app_llm_prompt_eval_seconds', 'Prompt evaluation time reported by the LLM server')
+LLM_COMPLETION_TOKENS = Counter('app_llm_completion_tokens_total', 'Completion tokens reported by the LLM server')
+LLM_GENERATION_SECONDS = Histogram('app_llm_generation_seconds', 'Token generation time reported by the LLM server')
+LLM_TOKENS_PER_SECOND = Histogram(
+    'app_llm_generation_tokens_per_second',
+    'Generation speed reported by the LLM server',
+    buckets=(1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+)
+LLM_PROMPT_CACHE = Counter('app_llm_prompt_cache_requests_total', 'LLM requests that could or could not reuse a cached prompt prefix', ['result'])
+LLM_TIME_TO_FIRST_TOKEN = Histogram('app_llm_time_to_first_token_seconds', 'Time from sending a streaming request until the first content token')
+LLM_REQUEST_DURATION = Histogram('app_llm_request_duration_seconds', 'Time spent on a whole LLM request', ['mode', 'status'])
+
+class LLMError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"LLM request failed with status {status_code}")
+        self.status_code = status_code
+
+class LLMOverloaded(LLMError):
+    def __init__(self, overloaded: admission.Overloaded):
+        super().__init__(429 if overloaded.reason == "full" else 503)
+        self.retry_after = overloaded.retry_after
+
+def check_admission(priority: str):
+    try:
+        backends.check(priority)
+    except admission.Overloaded as e:
+        raise LLMOverloaded(e)
+
+@asynccontextmanager
+async def admitted(priority: str, cache_key: str | None = None):
+    backend = backends.pick(priority, cache_key)
+    try:
+        async with backend.slot(priority):
+            yield backend
+    except admission.Overloaded as e:
+        raise LLMOverloaded(e)
+
+def strip_thinking(content: str):
+    return re.sub("^(\n|.)*</think>\\s*", "", content).strip()
+
+class ThinkFilter:
+    # streams what strip_thinking would keep. Output that starts with <think> is held until the tag
+    # closes; for backends whose chat template opens the tag itself (think_hold > 0) any output is held
+    # until </think> shows up or think_hold characters have passed without one
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self, hold_chars: int = 0):
+        self.hold_chars = hold_chars
+        self.content = ""
+        self.emitted = ""
+        self.pending = ""
+        self.holding = True
+        self.closed = False
+
+    def emit(self, text: str):
+        self.emitted += text
+        return text
+
+    def reasoning(self):
+        stripped = self.pending.lstrip()
+        return not self.closed and (stripped.startswith(self.OPEN_TAG) or self.OPEN_TAG.startswith(stripped))
+
+    def feed(self, token: str):
+        self.content += token
+        if not self.holding:
+            return self.emit(token)
+        self.pending += token
+        if self.CLOSE_TAG in self.pending:
+            self.pending = self.pending.rsplit(self.CLOSE_TAG, 1)[1].lstrip()
+            self.closed = True
+        elif self.closed:
+            self.pending = self.pending.lstrip()
+        elif len(self.pending) < self.hold_chars or self.reasoning():
+            return ""
+        if not self.pending:
+            return ""
+        self.holding = False
+        out, self.pending = self.pending, ""
+        return self.emit(out)
+
+    def flush(self):
+        # an unclosed <think> is kept, like strip_thinking does
+        out, self.pending = self.pending, ""
+        if not self.emitted:
+            out = out.strip()
+        return self.emit(out.rstrip())
+
+def record_timings(timings: dict | None):
+    if not timings:
+        return
+    if "cache_n" in timings:
+        LLM_PROMPT_TOKENS.labels(source="cached").inc(timings["cache_n"])
+        LLM_PROMPT_CACHE.labels(result="hit" if timings["cache_n"] > 0 else "miss").inc()
+    if "prompt_n" in timings:
+        LLM_PROMPT_TOKENS.labels(source="evaluated").inc(timings["prompt_n"])
+    if "prompt_ms" in timings:
+        LLM_PROMPT_SECONDS.observe(timings["prompt_ms"] / 1000)
+    if "predicted_n" in timings:
+        LLM_COMPLETION_TOKENS.inc(timings["predicted_n"])
+    if "predicted_ms" in timings:
+        LLM_GENERATION_SECONDS.observe(timings["predicted_ms"] / 1000)
+    if timings.get("predicted_per_second"):
+        LLM_TOKENS_PER_SECOND.observe(timings["predicted_per_second"])
+
+def backoff_delay(attempt: int):
+    return llm_backoff * (2 ** attempt) * (0.5 + random.random())
+
+async def post_completion(payload: dict, priority: str, cache_key: str | None = None, timeout: float | None = None):
+    # every attempt picks a backend again, so a retry can land on a healthy replica
+    for attempt in range(llm_retries + 1):
+        async with admitted(priority, cache_key) as backend:
+            try:
+                response = await backend.client.post(
+                    "/v1/chat/completions",
+                    json={**payload, "model": backend.model, **backend.cache_options(cache_key)},
+                    timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout,
+                )
+            except httpx.TimeoutException:
+                backend.failure("timeout")
+                if attempt >= llm_retries:
+                    raise LLMError(504)
+            except httpx.TransportError:
+                backend.failure("transport")
+                if attempt >= llm_retries:
+                    raise LLMError(502)
+            else:
+                if response.status_code == 200:
+                    backend.success()
+                    return response.json()
+                if response.status_code >= 500:
+                    backend.failure(f"{response.status_code}")
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= llm_retries:
+                    raise LLMError(response.status_code)
+        await asyncio.sleep(backoff_delay(attempt))
+    raise LLMError(502)
+
+async def cancel_on_disconnect(awaitable, request: Request | None):
+    if request is None:
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=1)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            raise LLMError(499)
+
+async def chat_completion(messages: list, request: Request | None = None, timeout: float | None = None, priority: str = admission.INTERACTIVE, cache_key: str | None = None, **options):
+    payload = {
+        "messages": messages,
+        **options,
+    }
+    start_time = time.time()
+    status = "ok"
+    try:
+        response = await cancel_on_disconnect(post_completion(payload, priority, cache_key, timeout), request)
+    except LLMError as e:
+        status = f"{e.status_code}"
+        raise
+    finally:
+        LLM_REQUEST_DURATION.labels(mode="blocking", status=status).observe(time.time() - start_time)
+    record_timings(response.get("timings"))
+    return strip_thinking(response["choices"][0]["message"]["content"])
+
+async def stream_chat_completion(messages: list, priority: str = admission.INTERACTIVE, cache_key: str | None = None, think_filter: ThinkFilter | None = None, **options):
+    payload = {
+        "messages": messages,
+        "stream": True,
+        **options,
+    }
+    start_time = time.time()
+    first_token = True
+    status = "ok"
+    backend = None
+    try:
+        async with admitted(priority, cache_key) as backend, backend.client.stream(
+            "POST",
+            "/v1/chat/completions",
+            json={**payload, "model": backend.model, **backend.cache_options(cache_key)}
+        ) as response:
+            if response.status_code != 200:
+                if response.status_code >= 500:
+                    backend.failure(f"{response.status_code}")
+                raise LLMError(response.status_code)
+            backend.success()
+            if think_filter is not None:
+                think_filter.hold_chars = backend.think_hold
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                record_timings(chunk.get("timings"))
+                choices = chunk.get("choices") or [{}]
+                token = (choices[0].get("delta") or {}).get("content")
+                if token:
+                    if first_token:
+                        first_token = False
+                        LLM_TIME_TO_FIRST_TOKEN.observe(time.time() - start_time)
+                    yield token
+    except LLMError as e:
+        status = f"{e.status_code}"
+        raise
+    except httpx.TimeoutException:
+        status = "504"
+        if backend is not None:
+            backend.failure("timeout")
+        raise LLMError(504)
+    except httpx.TransportError:
+        status = "502"
+        if backend is not None:
+            backend.failure("transport")
+        raise LLMError(502)
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "cancelled"
+        raise
+    finally:
+        LLM_REQUEST_DURATION.labels(mode="stream", status=status).observe(time.time() - start_time)
+
+TOKENIZE_SEPARATOR = "\n\n"
+
+def attribute_tokens(texts: list, tokens: list):
+    # every token counts for the text its first byte belongs to, separator tokens go to the next text
+    ends = []
+    offset = 0
+    for text in texts:
+        offset += len(text.encode("utf-8"))
+        ends.append(offset)
+        offset += len(TOKENIZE_SEPARATOR)
+    counts = [0] * len(texts)
+    position = 0
+    index = 0
+    for token in tokens:
+        while index < len(ends) - 1 and position >= ends[index]:
+            index += 1
+        counts[index] += 1
+        piece = token["piece"]
+        position += len(piece.encode("utf-8")) if isinstance(piece, str) else len(piece)
+    return counts
+
+async def count_tokens(texts: list):
+    # one request per prompt: the texts are tokenized as one string and split again by the token pieces.
+    # The interactive backends get the chat prompts, so their tokenizer is the one the budget has to match
+    backend = backends.pick(admission.INTERACTIVE)
+    try:
+        response = await backend.client.post(
+            "/tokenize",
+            json={"content": TOKENIZE_SEPARATOR.join(texts), "with_pieces": True},
+            timeout=tokenize_timeout,
+        )
+    except httpx.TimeoutException:
+        backend.failure("timeout")
+        raise LLMError(504)
+    except httpx.TransportError:
+        backend.failure("transport")
+        raise LLMError(502)
+    if response.status_code != 200:
+        if response.status_code >= 500:
+            backend.failure(f"{response.status_code}")
+        raise LLMError(response.status_code)
+    backend.success()
+    return attribute_tokens(texts, response.json()["tokens"])
+
+async def close():
+    await backends.close()
@@ -0,0 +1,76 @@
+import argparse
+import time
+
+import mariadb
+
+from . import database, storage
+from .functions import mariadb_name
+
+def copy_messages(user_id: str, chat_id: str, batch_size: int, pause: float):
+    source = mariadb_name(user_id, chat_id)
+    last_aid = 0
+    copied = 0
+    while True:
+        rows = database.fetch_all_blocking(
+            f"SELECT aid, creator, content FROM `{source}`.messages WHERE aid > ? ORDER BY aid LIMIT ?;",
+            [last_aid, batch_size]
+        )
+        if not rows:
+            return copied
+        with database.connection() as conn:
+            conn.cursor().executemany(
+                "INSERT IGNORE INTO chat_store.messages (user_id, chat_id, aid, creator, content) VALUES (?, ?, ?, ?, ?);",
+                [(user_id, chat_id, row[0], row[1], row[2]) for row in rows]
+            )
+        copied += len(rows)
+        last_aid = rows[-1][0]
+        time.sleep(pause)
+
+def copy_documents(user_id: str, chat_id: str, batch_size: int, pause: float):
+    source = mariadb_name(user_id, chat_id)
+    last_id = ""
+    copied = 0
+    while True:
+        rows = database.fetch_all_blocking(
+            f"SELECT * FROM `{source}`.documents WHERE id > ? ORDER BY id LIMIT ?;",
+            [last_id, batch_size]
+        )
+        if not rows:
+            return copied
+        with database.connection() as conn:
+            conn.cursor().executemany(
+                "INSERT IGNORE INTO chat_store.documents (user_id, chat_id, id, name, content) VALUES (?, ?, ?, ?, ?);",
+                [(user_id, chat_id, row[0], row[1], row[2]) for row in rows]
+            )
+        copied += len(rows)
+        last_id = rows[-1][0]
+        time.sleep(pause)
+
+def source_exists(user_id: str, chat_id: str):
+    return database.fetch_one_blocking(
+        "SELECT SCHEMA_NAME FROM information_schema.SCHEMATA WHERE SCHEMA_NAME = ?;",
+        [mariadb_name(user_id, chat_id)]
+    ) is not None
+
+def migrate(batch_size: int, pause: float, drop_source: bool):
+    storage.setup_blocking()
+    for user_id, chat_id in database.fetch_all_blocking("SELECT user_id, chat_id FROM chat_users.mapping ORDER BY user_id, chat_id;"):
+        if not source_exists(user_id, chat_id):
+            continue
+        try:
+            messages = copy_messages(user_id, chat_id, batch_size, pause)
+            documents = copy_documents(user_id, chat_id, batch_size, pause)
+        except mariadb.Error as e:
+            print(f"{user_id}-{chat_id}: {e}")
+            continue
+        print(f"{user_id}-{chat_id}: {messages} messages, {documents} documents")
+        if drop_source:
+            database.execute_blocking(f"DROP DATABASE `{mariadb_name(user_id, chat_id)}`;")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy per-chat MariaDB databases into the shared chat_store tables.")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between batches")
+    parser.add_argument("--drop-source", action="store_true", help="drop each per-chat database once it has been copied")
+    args = parser.parse_args()
+    migrate(args.batch_size, args.pause, args.drop_source)
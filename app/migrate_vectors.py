@@ -0,0 +1,51 @@
+import argparse
+import time
+
+from qdrant_client.http.models import PointStruct
+
+from .clients import qdrant
+from . import database, vectors
+
+def copy_collection(source: str, user_id: str, chat_id: str, kind: str, batch_size: int, pause: float):
+    if not qdrant.collection_exists(source):
+        return 0
+    copied = 0
+    offset = None
+    while True:
+        records, offset = qdrant.scroll(source, limit=batch_size, offset=offset, with_payload=True, with_vectors=True)
+        if records:
+            qdrant.upsert(
+                vectors.shared_collection,
+                points=[
+                    PointStruct(
+                        id=record.id,
+                        vector=record.vector,
+                        payload={**(record.payload or {}), "user_id": user_id, "chat_id": chat_id, "kind": kind},
+                    )
+                    for record in records
+                ],
+                wait=True,
+            )
+            copied += len(records)
+        if offset is None:
+            return copied
+        time.sleep(pause)
+
+def migrate(batch_size: int, pause: float, drop_source: bool):
+    vectors.setup_blocking()
+    for user_id, chat_id in database.fetch_all_blocking("SELECT user_id, chat_id FROM chat_users.mapping ORDER BY user_id, chat_id;"):
+        sources = [(f"{user_id}-{chat_id}", vectors.HISTORY), (chat_id, vectors.DOCUMENT)]
+        for source, kind in sources:
+            copied = copy_collection(source, user_id, chat_id, kind, batch_size, pause)
+            if copied:
+                print(f"{source}: {copied} {kind} points")
+            if drop_source and qdrant.collection_exists(source):
+                qdrant.delete_collection(source)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy per-chat Qdrant collections into the shared collection.")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between batches")
+    parser.add_argument("--drop-source", action="store_true", help="delete each per-chat collection once it has been copied")
+    args = parser.parse_args()
+    migrate(args.batch_size, args.pause, args.drop_source)
@@ -0,0 +1,67 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
+from prometheus_client import Counter, Histogram, Gauge
+
+hash_workers = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+hash_queue_size = int(os.getenv('PASSWORD_HASH_QUEUE', '32'))
+retry_after = int(os.getenv('PASSWORD_HASH_RETRY_AFTER', '2'))
+
+hasher = PasswordHasher(
+    time_cost=int(os.getenv('ARGON2_TIME_COST', '3')),
+    memory_cost=int(os.getenv('ARGON2_MEMORY_COST', '65536')),
+    parallelism=int(os.getenv('ARGON2_PARALLELISM', '4')),
+)
+# argon2-cffi releases the GIL while hashing, so threads are enough to keep it off the event loop
+executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="argon2")
+pending = 0
+
+PASSWORD_QUEUE_WAIT = Histogram('app_password_queue_wait_seconds', 'Time a password operation waited for a hashing worker', ['operation'])
+PASSWORD_DURATION = Histogram('app_password_duration_seconds', 'Time spent hashing or verifying a password', ['operation'])
+PASSWORD_PENDING = Gauge('app_password_pending', 'Password operations running or waiting for a hashing worker', multiprocess_mode='livesum')
+PASSWORD_REJECTED = Counter('app_password_rejected_total', 'Password operations rejected because the hashing pool was saturated', ['operation'])
+
+class PasswordPoolSaturated(Exception):
+    def __init__(self):
+        super().__init__("Password hashing pool is saturated")
+        self.retry_after = retry_after
+
+def timed(operation: str, queued_at: float, function, *args):
+    start_time = time.time()
+    PASSWORD_QUEUE_WAIT.labels(operation=operation).observe(start_time - queued_at)
+    try:
+        return function(*args)
+    finally:
+        PASSWORD_DURATION.labels(operation=operation).observe(time.time() - start_time)
+
+async def run(operation: str, function, *args):
+    global pending
+    if pending >= hash_workers + hash_queue_size:
+        PASSWORD_REJECTED.labels(operation=operation).inc()
+        raise PasswordPoolSaturated()
+    pending += 1
+    PASSWORD_PENDING.set(pending)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, timed, operation, time.time(), function, *args)
+    finally:
+        pending -= 1
+        PASSWORD_PENDING.set(pending)
+
+def verify_blocking(password_hash: str, password: str):
+    try:
+        return hasher.verify(password_hash, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+async def hash_password(password: str):
+    return await run("hash", hasher.hash, password)
+
+async def verify_password(password_hash: str, password: str):
+    return await run("verify", verify_blocking, password_hash, password)
+
+def needs_rehash(password_hash: str):
+    return hasher.check_needs_rehash(password_hash)
@@ -0,0 +1,215 @@
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict
+
+from prometheus_client import Histogram, Counter
+
+from .functions import get_rules, get_schema
+from . import llm
+
+token_budget = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))
+chars_per_token = float(os.getenv('PROMPT_CHARS_PER_TOKEN', '3.5'))
+prompt_layout = os.getenv('PROMPT_LAYOUT', 'stable-prefix')
+token_cache_size = int(os.getenv('PROMPT_TOKEN_CACHE_SIZE', '10000'))
+tokenizer_retry_seconds = float(os.getenv('PROMPT_TOKENIZER_RETRY_SECONDS', '30'))
+token_cache = OrderedDict()
+tokenizer_down_until = 0
+
+STABLE_PREFIX = "stable-prefix"
+LEGACY = "legacy"
+
+PROMPT_SECTION_TOKENS = Histogram(
+    'app_prompt_section_tokens',
+    'Tokens per prompt section after budgeting',
+    ['section'],
+    buckets=(0, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+)
+PROMPT_SECTION_TRIMMED = Counter('app_prompt_section_trimmed_total', 'Prompt sections that were truncated or dropped', ['section'])
+PROMPT_TOKEN_COUNTS = Counter('app_prompt_token_counts_total', 'Prompt texts whose tokens were counted, by where the count came from', ['source'])
+
+def estimate_tokens(text: str):
+    return math.ceil(len(text) / chars_per_token)
+
+def cache_key(text: str):
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+def cache_tokens(text: str, tokens: int):
+    token_cache[cache_key(text)] = tokens
+    if len(token_cache) > token_cache_size:
+        token_cache.popitem(last=False)
+
+async def count_texts(texts: list):
+    # rules, schema, rendered sheets and older messages repeat every turn, so most counts come from the cache
+    # and the rest goes to the tokenizer in a single request
+    global tokenizer_down_until
+    counts = {}
+    missing = []
+    for text in dict.fromkeys(text for text in texts if text):
+        key = cache_key(text)
+        if key in token_cache:
+            token_cache.move_to_end(key)
+            counts[text] = token_cache[key]
+        else:
+            missing.append(text)
+    PROMPT_TOKEN_COUNTS.labels(source="cache").inc(len(counts))
+    if not missing:
+        return counts
+    if time.time() >= tokenizer_down_until:
+        try:
+            tokens = await llm.count_tokens(missing)
+        except llm.LLMError as e:
+            # later turns go straight to the estimate instead of waiting for the same failure
+            print(f"tokenizer unavailable, estimating for {tokenizer_retry_seconds}s: {e}")
+            tokenizer_down_until = time.time() + tokenizer_retry_seconds
+        else:
+            for text, count in zip(missing, tokens):
+                counts[text] = count
+                cache_tokens(text, count)
+            PROMPT_TOKEN_COUNTS.labels(source="tokenizer").inc(len(missing))
+            return counts
+    for text in missing:
+        counts[text] = estimate_tokens(text)
+    PROMPT_TOKEN_COUNTS.labels(source="estimate").inc(len(missing))
+    return counts
+
+def truncate_to_tokens(text: str, tokens: int, total: int):
+    if tokens <= 0:
+        return ""
+    # cut by the text's own measured density rather than a fixed characters-per-token ratio
+    return text[:int(len(text) * tokens / max(total, 1))]
+
+class Budget:
+    def __init__(self, total: int, counts: dict | None = None):
+        self.remaining = total
+        self.sections = {}
+        self.counts = counts or {}
+
+    def count(self, text: str):
+        if text in self.counts:
+            return self.counts[text]
+        return estimate_tokens(text)
+
+    def take(self, section: str, text: str, force: bool = False):
+        tokens = self.count(text)
+        if tokens > self.remaining and not force:
+            return False
+        self.use(section, tokens)
+        return True
+
+    def use(self, section: str, tokens: int):
+        self.remaining -= tokens
+        self.sections[section] = self.sections.get(section, 0) + tokens
+
+    def take_truncated(self, section: str, text: str):
+        if self.take(section, text):
+            return text
+        PROMPT_SECTION_TRIMMED.labels(section=section).inc()
+        text = truncate_to_tokens(text, self.remaining, self.count(text))
+        self.use(section, max(self.remaining, 0) if text else 0)
+        return text
+
+def system_message(content: str):
+    return {
+        "role": "system",
+        "content": content.strip()
+    }
+
+def legacy_layout(rules: str, schema: str, characters: str, summaries: str, history: list, retrieval: str):
+    messages = history + [system_message(rules)]
+    dynamic = characters + schema + summaries + retrieval
+    if dynamic.strip():
+        messages.append(system_message(dynamic))
+    return messages
+
+def stable_prefix_layout(rules: str, schema: str, characters: str, summaries: str, history: list, retrieval: str):
+    # ordered from least to most frequently changing, so llama.cpp can reuse
+    # the cached prefix of the previous turn up to the first changed message
+    messages = [system_message(rules + "\n" + schema)]
+    if (characters + summaries).strip():
+        messages.append(system_message(characters + summaries))
+    messages += history
+    if retrieval:
+        messages.append(system_message(retrieval))
+    return messages
+
+def characters_section(context: dict):
+    if context["characters"] in ("", "[]"):
+        return "", ""
+    characters_text = "# Player Characters:\nThe following character sheets are for reference ONLY."\
+        " Do not use these to infer motivations or write actions for player characters."\
+        "\n```json\n" + context["characters"] + "\n```\n"
+    schema_text = "## Character Sheet Schema:\n```json\n" + get_schema() + "\n```\n"
+    return characters_text, schema_text
+
+def summary_sections(context: dict):
+    sections = {}
+    if len(context["world"]) > 0:
+        sections["world"] = "# World:\n" + context["world"] + "\n"
+    for title, key in [("Short", "short_term_summary"), ("Medium", "medium_term_summary"), ("Long", "long_term_summary")]:
+        if context[key] != "":
+            sections[key] = f"# {title} Term Summary:\n" + context[key] + "\n"
+    return sections
+
+async def build_messages(context: dict, description: str):
+    rules = get_rules()
+    characters_text, schema_text = characters_section(context)
+    summary_texts = summary_sections(context)
+    counts = await count_texts(
+        [rules, description, characters_text, schema_text, *summary_texts.values(), *context["vectordb_results"]]
+        + [message[1] for message in context["old_messages"]]
+    )
+    budget = Budget(token_budget, counts)
+    budget.take("rules", rules, True)
+    budget.take("action", description, True)
+
+    history = []
+    for message in reversed(context["old_messages"]):
+        if not budget.take("messages", message[1]):
+            PROMPT_SECTION_TRIMMED.labels(section="messages").inc()
+            break
+        history.insert(0, {
+            "role": message[0],
+            "content": message[1],
+        })
+
+    characters = ""
+    schema = ""
+    if characters_text:
+        if budget.take("characters", characters_text):
+            characters = characters_text
+            if budget.take("characters", schema_text):
+                schema = schema_text
+            else:
+                PROMPT_SECTION_TRIMMED.labels(section="characters").inc()
+        else:
+            PROMPT_SECTION_TRIMMED.labels(section="characters").inc()
+
+    summaries = ""
+    for key, text in summary_texts.items():
+        if key == "world" or budget.remaining > 0:
+            summaries += budget.take_truncated("summaries", text)
+
+    retrieval = ""
+    if len(context["vectordb_results"]) > 0 and budget.remaining > 0:
+        results = []
+        for result in context["vectordb_results"]:
+            if not budget.take("retrieval", result):
+                PROMPT_SECTION_TRIMMED.labels(section="retrieval").inc()
+                break
+            results.append(result)
+        if results:
+            retrieval = "# Potentially Related Information:\n" + "\n---\n".join(results) + "\n"
+
+    if prompt_layout == STABLE_PREFIX:
+        messages = stable_prefix_layout(rules, schema, characters, summaries, history, retrieval)
+    else:
+        messages = legacy_layout(rules, schema, characters, summaries, history, retrieval)
+    messages.append({
+        "role": "user",
+        "content": description,
+    })
+    for section, tokens in budget.sections.items():
+        PROMPT_SECTION_TOKENS.labels(section=section).observe(tokens)
+    return messages, budget.sections
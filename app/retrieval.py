@@ -0,0 +1,58 @@
+import math
+import os
+
+from qdrant_client.http.models import ScoredPoint
+
+from .functions import simplify_result
+
+candidate_count = int(os.getenv('RETRIEVAL_CANDIDATES', '20'))
+result_count = int(os.getenv('RETRIEVAL_RESULTS', '5'))
+score_threshold = float(os.getenv('RETRIEVAL_SCORE_THRESHOLD', '0.5'))
+mmr_lambda = float(os.getenv('RETRIEVAL_MMR_LAMBDA', '0.7'))
+
+def cosine(a: list, b: list):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def point_vector(point: ScoredPoint):
+    if isinstance(point.vector, dict):
+        return next(iter(point.vector.values()), None)
+    return point.vector
+
+def in_recent_window(point: ScoredPoint, old_messages: list):
+    if not old_messages:
+        return False
+    aid = (point.payload or {}).get("aid")
+    if aid is not None:
+        return aid >= old_messages[0][2]
+    document = simplify_result(point)
+    return any(message[1] and document.endswith(message[1]) for message in old_messages)
+
+def maximal_marginal_relevance(points: list, limit: int):
+    selected = []
+    candidates = [(point, point_vector(point)) for point in points]
+    while candidates and len(selected) < limit:
+        best = None
+        best_score = None
+        for point, vector in candidates:
+            redundancy = 0.0
+            if vector is not None:
+                redundancy = max((cosine(vector, other) for _, other in selected if other is not None), default=0.0)
+            score = mmr_lambda * point.score - (1 - mmr_lambda) * redundancy
+            if best_score is None or score > best_score:
+                best, best_score = (point, vector), score
+        selected.append(best)
+        candidates.remove(best)
+    return [point for point, _ in selected]
+
+def select(points: list, old_messages: list):
+    seen = set()
+    unique = []
+    for point in points:
+        document = simplify_result(point)
+        if document in seen or in_recent_window(point, old_messages):
+            continue
+        seen.add(document)
+        unique.append(point)
+    return [simplify_result(point) for point in maximal_marginal_relevance(unique, result_count)]
@@ -0,0 +1,20 @@
+import os
+import shutil
+
+import uvicorn
+
+workers = int(os.getenv('APP_WORKERS', '1'))
+
+if __name__ == "__main__":
+    if workers > 1:
+        # each worker is a spawned process that imports the app and creates its own clients
+        directory = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus')
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=int(os.getenv('APP_PORT', '80')),
+        workers=workers,
+        proxy_headers=True,
+    )
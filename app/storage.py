@@ -0,0 +1,271 @@
+import os
+
+from . import database
+from .functions import mariadb_name
+
+storage_mode = os.getenv('CHAT_STORAGE_MODE', 'per-chat')
+message_partitions = int(os.getenv('CHAT_STORAGE_PARTITIONS', '0'))
+
+SHARED = "shared"
+PER_CHAT = "per-chat"
+
+def is_shared():
+    return storage_mode == SHARED
+
+def partition_clause():
+    if message_partitions > 0:
+        return f" PARTITION BY KEY(user_id, chat_id) PARTITIONS {message_partitions}"
+    return ""
+
+def setup_blocking():
+    database.execute_blocking("CREATE DATABASE IF NOT EXISTS `chat_store`;")
+    database.execute_blocking(
+        "CREATE TABLE IF NOT EXISTS chat_store.messages (user_id char(36) NOT NULL, chat_id char(36) NOT NULL,"
+        " aid BIGINT NOT NULL AUTO_INCREMENT, creator varchar(6), content text,"
+        " PRIMARY KEY(user_id, chat_id, aid), KEY(aid)) charset=utf8" + partition_clause() + ";"
+    )
+    database.execute_blocking(
+        "CREATE TABLE IF NOT EXISTS chat_store.documents (user_id char(36) NOT NULL, chat_id char(36) NOT NULL,"
+        " id char(36) NOT NULL, name varchar(255), content text,"
+        " PRIMARY KEY(user_id, chat_id, id)) charset=utf8" + partition_clause() + ";"
+    )
+
+async def create_tables(user_id: str, chat_id: str):
+    if is_shared():
+        return
+    await database.execute(
+        f"CREATE DATABASE IF NOT EXISTS `{mariadb_name(user_id, chat_id)}`;"
+    )
+    await database.execute(
+        f"CREATE TABLE IF NOT EXISTS `{mariadb_name(user_id, chat_id)}`.messages (aid BIGINT NOT NULL AUTO_INCREMENT, creator varchar(6),"
+        "content text, PRIMARY KEY(aid)) charset=utf8;"
+    )
+    await database.execute(
+        f"CREATE TABLE IF NOT EXISTS `{mariadb_name(user_id, chat_id)}`.documents (id char(36) NOT NULL, name varchar(255),"
+        "content text, PRIMARY KEY(id)) charset=utf8;"
+    )
+
+async def create_chat(user_id: str, chat_id: str):
+    await create_tables(user_id, chat_id)
+    await database.execute(
+        "INSERT INTO chat_users.mapping (chat_id, user_id, chat_name) VALUES (?, ?, ?)",
+        [chat_id, user_id, chat_id]
+    )
+
+async def delete_chat(user_id: str, chat_id: str):
+    if is_shared():
+        await database.execute("DELETE FROM chat_store.messages WHERE user_id=? AND chat_id=?;", [user_id, chat_id])
+        await database.execute("DELETE FROM chat_store.documents WHERE user_id=? AND chat_id=?;", [user_id, chat_id])
+        return
+    await database.execute(f"DROP DATABASE `{mariadb_name(user_id, chat_id)}`;")
+
+def add_messages_blocking(user_id: str, chat_id: str, messages: list, job_id: str | None = None):
+    # with a job id the insert is recorded in the same transaction, so a replayed job returns the
+    # aid of its first run instead of inserting the messages again
+    with database.connection() as conn:
+        conn.begin()
+        try:
+            cursor = conn.cursor()
+            if job_id is not None:
+                cursor.execute("SELECT aid FROM chat_users.applied_jobs WHERE job_id=? FOR UPDATE;", [job_id])
+                applied = cursor.fetchone()
+                if applied:
+                    conn.rollback()
+                    return applied[0]
+            for creator, content in messages:
+                if is_shared():
+                    cursor.execute(
+                        "INSERT INTO chat_store.messages (user_id, chat_id, creator, content) VALUES (?, ?, ?, ?);",
+                        [user_id, chat_id, creator, content]
+                    )
+                else:
+                    cursor.execute(
+                        f"INSERT INTO `{mariadb_name(user_id, chat_id)}`.messages (`creator`, `content`) VALUES (?, ?);",
+                        [creator, content]
+                    )
+            aid = cursor.lastrowid
+            if job_id is not None:
+                cursor.execute("INSERT INTO chat_users.applied_jobs (job_id, aid) VALUES (?, ?);", [job_id, aid])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return aid
+
+async def add_messages(user_id: str, chat_id: str, messages: list, job_id: str | None = None):
+    return await database.run(add_messages_blocking, user_id, chat_id, messages, job_id)
+
+async def purge_applied_jobs(max_age: int):
+    await database.execute("DELETE FROM chat_users.applied_jobs WHERE created_at < NOW() - INTERVAL ? SECOND;", [max_age])
+
+async def recent_messages(user_id: str, chat_id: str, limit: int):
+    if is_shared():
+        return await database.fetch_all(
+            "SELECT * FROM (SELECT creator, content, aid FROM chat_store.messages WHERE user_id=? AND chat_id=?"
+            " ORDER BY aid DESC LIMIT ?) as a ORDER BY aid;",
+            [user_id, chat_id, limit]
+        )
+    return await database.fetch_all(
+        f"SELECT * FROM (SELECT creator, content, aid FROM `{mariadb_name(user_id, chat_id)}`.messages ORDER BY aid DESC LIMIT ?) as a ORDER BY aid;",
+        [limit]
+    )
+
+async def count_messages_between(user_id: str, chat_id: str, after_aid: int, before_aid: int):
+    if is_shared():
+        row = await database.fetch_one(
+            "SELECT COUNT(*) FROM chat_store.messages WHERE user_id=? AND chat_id=? AND aid > ? AND aid < ?;",
+            [user_id, chat_id, after_aid, before_aid]
+        )
+    else:
+        row = await database.fetch_one(
+            f"SELECT COUNT(*) FROM `{mariadb_name(user_id, chat_id)}`.messages WHERE aid > ? AND aid < ?;",
+            [after_aid, before_aid]
+        )
+    return row[0] if row else 0
+
+async def messages_between(user_id: str, chat_id: str, after_aid: int, before_aid: int, limit: int):
+    # oldest first, so a caller that stores the last aid it saw can page forward without gaps
+    if is_shared():
+        return await database.fetch_all(
+            "SELECT creator, content, aid FROM chat_store.messages WHERE user_id=? AND chat_id=?"
+            " AND aid > ? AND aid < ? ORDER BY aid LIMIT ?;",
+            [user_id, chat_id, after_aid, before_aid, limit]
+        )
+    return await database.fetch_all(
+        f"SELECT creator, content, aid FROM `{mariadb_name(user_id, chat_id)}`.messages"
+        " WHERE aid > ? AND aid < ? ORDER BY aid LIMIT ?;",
+        [after_aid, before_aid, limit]
+    )
+
+def messages_source(user_id: str, chat_id: str):
+    if is_shared():
+        return "chat_store.messages", ["user_id=?", "chat_id=?"], [user_id, chat_id]
+    return f"`{mariadb_name(user_id, chat_id)}`.messages", [], []
+
+def page_query(user_id: str, chat_id: str, before: int | None, after: int | None, limit: int | None):
+    table, conditions, parameters = messages_source(user_id, chat_id)
+    if after is not None:
+        conditions.append("aid > ?")
+        parameters.append(after)
+    if before is not None:
+        conditions.append("aid < ?")
+        parameters.append(before)
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    if limit is None:
+        return f"SELECT creator, content, aid FROM {table}{where} ORDER BY aid;", parameters
+    parameters.append(limit)
+    if after is not None and before is None:
+        return f"SELECT creator, content, aid FROM {table}{where} ORDER BY aid LIMIT ?;", parameters
+    return f"SELECT * FROM (SELECT creator, content, aid FROM {table}{where} ORDER BY aid DESC LIMIT ?) as a ORDER BY aid;", parameters
+
+async def messages_page(user_id: str, chat_id: str, before: int | None = None, after: int | None = None, limit: int | None = None):
+    return await database.fetch_all(*page_query(user_id, chat_id, before, after, limit))
+
+def iter_messages_blocking(user_id: str, chat_id: str, before: int | None = None, after: int | None = None, limit: int | None = None, batch_size: int = 500):
+    # unbuffered cursor: rows are streamed from the server instead of being fetched into memory at once
+    with database.connection() as conn:
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(*page_query(user_id, chat_id, before, after, limit))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+
+async def newest_aid(user_id: str, chat_id: str):
+    table, conditions, parameters = messages_source(user_id, chat_id)
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    row = await database.fetch_one(f"SELECT MAX(aid) FROM {table}{where};", parameters)
+    return row[0] if row else None
+
+def documents_name_column(conn, user_id: str, chat_id: str):
+    # per-chat databases created by older versions call the column document_name
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA=? AND TABLE_NAME='documents' AND COLUMN_NAME='document_name';",
+        [mariadb_name(user_id, chat_id)]
+    )
+    legacy = cursor.fetchone()
+    cursor.close()
+    return "document_name" if legacy else "name"
+
+def iter_documents_blocking(user_id: str, chat_id: str, batch_size: int = 500):
+    with database.connection() as conn:
+        if is_shared():
+            cursor = conn.cursor(buffered=False)
+            cursor.execute("SELECT id, name, content FROM chat_store.documents WHERE user_id=? AND chat_id=?;", [user_id, chat_id])
+        else:
+            name_column = documents_name_column(conn, user_id, chat_id)
+            cursor = conn.cursor(buffered=False)
+            cursor.execute(f"SELECT id, {name_column}, content FROM `{mariadb_name(user_id, chat_id)}`.documents;")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+
+def restore_rows_blocking(query: str, rows: list):
+    with database.connection() as conn:
+        conn.begin()
+        try:
+            conn.cursor().executemany(query, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def restore_messages_blocking(user_id: str, chat_id: str, messages: list):
+    # aids are kept, the vector payloads of archived history points refer to them
+    if is_shared():
+        restore_rows_blocking(
+            "INSERT IGNORE INTO chat_store.messages (user_id, chat_id, aid, creator, content) VALUES (?, ?, ?, ?, ?);",
+            [(user_id, chat_id, aid, creator, content) for creator, content, aid in messages]
+        )
+        return
+    restore_rows_blocking(
+        f"INSERT IGNORE INTO `{mariadb_name(user_id, chat_id)}`.messages (aid, creator, content) VALUES (?, ?, ?);",
+        [(aid, creator, content) for creator, content, aid in messages]
+    )
+
+def restore_documents_blocking(user_id: str, chat_id: str, documents: list):
+    if is_shared():
+        restore_rows_blocking(
+            "INSERT IGNORE INTO chat_store.documents (user_id, chat_id, id, name, content) VALUES (?, ?, ?, ?, ?);",
+            [(user_id, chat_id, document_id, name, content) for document_id, name, content in documents]
+        )
+        return
+    restore_rows_blocking(
+        f"INSERT IGNORE INTO `{mariadb_name(user_id, chat_id)}`.documents (id, name, content) VALUES (?, ?, ?);",
+        documents
+    )
+
+async def list_documents(user_id: str, chat_id: str):
+    if is_shared():
+        return await database.fetch_all(
+            "SELECT id, name FROM chat_store.documents WHERE user_id=? AND chat_id=?;",
+            [user_id, chat_id]
+        )
+    return await database.fetch_all(f"SELECT id, name FROM `{mariadb_name(user_id, chat_id)}`.documents;")
+
+async def add_document(user_id: str, chat_id: str, document_id: str, name: str, content: str):
+    if is_shared():
+        await database.execute(
+            "INSERT INTO chat_store.documents (user_id, chat_id, id, name, content) VALUES (?, ?, ?, ?, ?);",
+            [user_id, chat_id, document_id, name, content]
+        )
+        return
+    await database.execute(
+        f"INSERT INTO `{mariadb_name(user_id, chat_id)}`.documents (id, name, content) VALUES (?, ?, ?);",
+        [document_id, name, content]
+    )
+
+async def delete_document(user_id: str, chat_id: str, document_id: str):
+    if is_shared():
+        await database.execute(
+            "DELETE FROM chat_store.documents WHERE user_id=? AND chat_id=? AND id=?;",
+            [user_id, chat_id, document_id]
+        )
+        return
+    await database.execute(f"DELETE FROM `{mariadb_name(user_id, chat_id)}`.documents WHERE id=?;", [document_id])
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import time
+
+from redis.asyncio import Redis as AsyncRedis
+
+from . import llm, storage, admission
+from .functions import as_text
+
+recent_window = int(os.getenv('SUMMARY_RECENT_WINDOW', '20'))
+
+SUMMARY_TIERS = {
+    "short": {
+        "batch": int(os.getenv('SUMMARY_SHORT_BATCH', '20')),
+        "instruction": "a brief paragraph about the most recent developments",
+    },
+    "medium": {
+        "batch": int(os.getenv('SUMMARY_MEDIUM_BATCH', '40')),
+        "instruction": "a brief paragraph about the current story arc",
+    },
+    "long": {
+        "batch": int(os.getenv('SUMMARY_LONG_BATCH', '80')),
+        "instruction": "a brief paragraph about the major developments of the whole story",
+    },
+}
+
+def summary_key(user_id: str, chat_id: str, tier: str):
+    return f"{user_id}-{chat_id}.{tier}_text_summary"
+
+def meta_key(user_id: str, chat_id: str, tier: str):
+    return f"{user_id}-{chat_id}.{tier}_text_summary_meta"
+
+def summary_keys(user_id: str, chat_id: str):
+    keys = []
+    for tier in SUMMARY_TIERS:
+        keys.append(summary_key(user_id, chat_id, tier))
+        keys.append(meta_key(user_id, chat_id, tier))
+    return keys
+
+def build_prompt(due: list, summaries: dict, extracts: dict):
+    out = "You maintain running summaries of a role play story at different levels of detail."\
+        " Update each summary listed below so that it also covers its own new story extract."\
+        " Answer with a JSON object that has exactly the keys " + ", ".join(due) + ".\n"
+    for tier in due:
+        out += f"\n# {tier}: {SUMMARY_TIERS[tier]['instruction']}\n"
+        out += "Current summary: " + (summaries[tier] or "(none yet)") + "\n"
+        out += "New story extract:\n" + extracts[tier]
+    return out
+
+def parse_summaries(due: list, content: str):
+    try:
+        parsed = json.loads(content[content.index("{"):content.rindex("}") + 1])
+    except ValueError:
+        if len(due) == 1:
+            return {due[0]: content}
+        return {}
+    return {tier: parsed[tier].strip() for tier in due if isinstance(parsed.get(tier), str) and parsed[tier].strip()}
+
+async def update_summaries(redis: AsyncRedis, user_id: str, chat_id: str):
+    recent = await storage.recent_messages(user_id, chat_id, recent_window)
+    if len(recent) < recent_window:
+        return
+    boundary = recent[0][2]
+    metas = {}
+    due = []
+    for tier, config in SUMMARY_TIERS.items():
+        metas[tier] = json.loads(await redis.get(meta_key(user_id, chat_id, tier)) or "{}")
+        pending = await storage.count_messages_between(user_id, chat_id, metas[tier].get("aid", 0), boundary)
+        if pending >= config["batch"]:
+            due.append(tier)
+    if not due:
+        return
+    # each tier folds only what it has not seen yet, paging forward from its own aid;
+    # anything beyond two batches stays pending and keeps the tier due for the next run
+    pages = await asyncio.gather(*[
+        storage.messages_between(user_id, chat_id, metas[tier].get("aid", 0), boundary, SUMMARY_TIERS[tier]["batch"] * 2)
+        for tier in due
+    ])
+    messages = dict(zip(due, pages))
+    extracts = {tier: "".join(message[1] + "\n" for message in messages[tier]) for tier in due}
+    summaries = {tier: as_text(await redis.get(summary_key(user_id, chat_id, tier))) for tier in due}
+    try:
+        content = await llm.chat_completion(
+            [{
+                "role": "user",
+                "content": build_prompt(due, summaries, extracts),
+            }],
+            priority=admission.SUMMARY,
+            response_format={"type": "json_object"},
+        )
+    except llm.LLMError as e:
+        print(e)
+        return
+    updated = parse_summaries(due, content)
+    for tier, text in updated.items():
+        await redis.set(summary_key(user_id, chat_id, tier), text)
+        await redis.set(meta_key(user_id, chat_id, tier), json.dumps({
+            "aid": messages[tier][-1][2],
+            "updated": time.time(),
+            "messages": metas[tier].get("messages", 0) + len(messages[tier]),
+        }))
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import time
+import uuid
+
+from prometheus_client import Counter, Histogram
+
+from .clients import redis
+
+lock_ttl_ms = int(os.getenv('TURN_LOCK_TTL_MS', '30000'))
+handoff_ttl_ms = int(os.getenv('TURN_HANDOFF_TTL_MS', '120000'))
+queue_size = int(os.getenv('TURN_QUEUE_SIZE', '0'))
+queue_timeout = float(os.getenv('TURN_QUEUE_TIMEOUT', '60'))
+queue_poll_interval = float(os.getenv('TURN_QUEUE_POLL_INTERVAL', '0.25'))
+ticket_ttl_ms = int(os.getenv('TURN_TICKET_TTL_MS', '5000'))
+
+TURN_QUEUE_WAIT = Histogram('app_turn_queue_wait_seconds', 'Time a chat turn waited for the per-chat turn lock')
+TURN_REJECTED = Counter('app_turn_rejected_total', 'Chat turns rejected because the chat was busy', ['reason'])
+
+# KEYS: lock, fence, queue, tickets
+# ARGV: ticket, lock ttl ms, now ms, ticket ttl ms, queue size
+# returns {token, position}: a fencing token once the lock is taken, otherwise the queue position or -1 if full
+ACQUIRE = """
+local now = tonumber(ARGV[3])
+while true do
+    local head = redis.call('lindex', KEYS[3], 0)
+    if not head then break end
+    local deadline = tonumber(redis.call('hget', KEYS[4], head))
+    if deadline and deadline >= now then break end
+    redis.call('lpop', KEYS[3])
+    redis.call('hdel', KEYS[4], head)
+end
+local head = redis.call('lindex', KEYS[3], 0)
+if redis.call('exists', KEYS[1]) == 0 and (not head or head == ARGV[1]) then
+    if head == ARGV[1] then
+        redis.call('lpop', KEYS[3])
+        redis.call('hdel', KEYS[4], ARGV[1])
+    end
+    local token = redis.call('incr', KEYS[2])
+    redis.call('set', KEYS[1], token, 'PX', ARGV[2])
+    return {token, 0}
+end
+if redis.call('hexists', KEYS[4], ARGV[1]) == 0 then
+    if redis.call('llen', KEYS[3]) >= tonumber(ARGV[5]) then
+        return {0, -1}
+    end
+    redis.call('rpush', KEYS[3], ARGV[1])
+end
+redis.call('hset', KEYS[4], ARGV[1], now + tonumber(ARGV[4]))
+redis.call('pexpire', KEYS[3], ARGV[2] + ARGV[4])
+redis.call('pexpire', KEYS[4], ARGV[2] + ARGV[4])
+return {0, redis.call('lpos', KEYS[3], ARGV[1]) + 1}
+"""
+EXTEND = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+acquire_script = redis.register_script(ACQUIRE)
+extend_script = redis.register_script(EXTEND)
+release_script = redis.register_script(RELEASE)
+
+class ChatBusy(Exception):
+    def __init__(self, position: int):
+        super().__init__("Chat is already active.")
+        self.position = position
+
+def lock_key(user_id: str, chat_id: str):
+    return f"{user_id}-{chat_id}.turn_lock"
+
+def keys(user_id: str, chat_id: str):
+    return [
+        lock_key(user_id, chat_id),
+        f"{user_id}-{chat_id}.turn_fence",
+        f"{user_id}-{chat_id}.turn_queue",
+        f"{user_id}-{chat_id}.turn_tickets",
+    ]
+
+def try_acquire(user_id: str, chat_id: str, ticket: str):
+    token, position = acquire_script(
+        keys=keys(user_id, chat_id),
+        args=[ticket, lock_ttl_ms, int(time.time() * 1000), ticket_ttl_ms, queue_size]
+    )
+    return int(token), int(position)
+
+def leave_queue(user_id: str, chat_id: str, ticket: str):
+    _, _, queue, tickets = keys(user_id, chat_id)
+    redis.lrem(queue, 0, ticket)
+    redis.hdel(tickets, ticket)
+
+async def acquire(user_id: str, chat_id: str, ticket: str | None = None):
+    ticket = ticket or str(uuid.uuid4())
+    start_time = time.time()
+    try:
+        while True:
+            token, position = try_acquire(user_id, chat_id, ticket)
+            if token:
+                TURN_QUEUE_WAIT.observe(time.time() - start_time)
+                return token
+            if position < 0:
+                TURN_REJECTED.labels(reason="queue_full").inc()
+                raise ChatBusy(position)
+            if time.time() - start_time > queue_timeout:
+                TURN_REJECTED.labels(reason="timeout").inc()
+                leave_queue(user_id, chat_id, ticket)
+                raise ChatBusy(position)
+            await asyncio.sleep(queue_poll_interval)
+    except asyncio.CancelledError:
+        leave_queue(user_id, chat_id, ticket)
+        raise
+
+def extend(user_id: str, chat_id: str, token: int, ttl_ms: int = lock_ttl_ms):
+    return extend_script(keys=[lock_key(user_id, chat_id)], args=[token, ttl_ms]) == 1
+
+def release(user_id: str, chat_id: str, token: int):
+    return release_script(keys=[lock_key(user_id, chat_id)], args=[token]) == 1
+
+async def keep_alive(user_id: str, chat_id: str, token: int):
+    while await asyncio.to_thread(extend, user_id, chat_id, token):
+        await asyncio.sleep(lock_ttl_ms / 3000)
+
+def hand_off(user_id: str, chat_id: str, token: int):
+    # the lock stays held until the worker has written the turn to the history
+    return extend(user_id, chat_id, token, handoff_ttl_ms)
+
+def status(user_id: str, chat_id: str, ticket: str | None = None):
+    lock, _, queue, _ = keys(user_id, chat_id)
+    out = {
+        "active": redis.exists(lock) == 1,
+        "queued": redis.llen(queue),
+    }
+    if ticket:
+        position = redis.lpos(queue, ticket)
+        out["position"] = None if position is None else position + 1
+    return out
+
+def delete(user_id: str, chat_id: str):
+    redis.delete(*keys(user_id, chat_id))
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import uuid
+
+from qdrant_client.http.models import PointStruct, Filter, FieldCondition, MatchValue, HasIdCondition, \
+    FilterSelector, KeywordIndexParams, PayloadSchemaType, ScalarQuantization, ScalarQuantizationConfig, \
+    ScalarType, BinaryQuantization, BinaryQuantizationConfig, HnswConfigDiff, SearchParams, QuantizationSearchParams
+
+from .clients import qdrant
+from . import embedding
+
+vector_storage_mode = os.getenv('QDRANT_STORAGE_MODE', 'per-chat')
+shared_collection = os.getenv('QDRANT_COLLECTION', 'chat_memory')
+quantization = os.getenv('QDRANT_QUANTIZATION', 'none')
+vectors_on_disk = os.getenv('QDRANT_VECTORS_ON_DISK', 'false') == 'true'
+hnsw_on_disk = os.getenv('QDRANT_HNSW_ON_DISK', 'false') == 'true'
+rescore = os.getenv('QDRANT_RESCORE', 'true') == 'true'
+oversampling = float(os.getenv('QDRANT_OVERSAMPLING', '2.0'))
+
+SHARED = "shared"
+PER_CHAT = "per-chat"
+
+HISTORY = "history"
+DOCUMENT = "document"
+
+def is_shared():
+    return vector_storage_mode == SHARED
+
+def collection_for(user_id: str, chat_id: str, kind: str):
+    if is_shared():
+        return shared_collection
+    if kind == DOCUMENT:
+        return chat_id
+    return f"{user_id}-{chat_id}"
+
+def tenant_filter(user_id: str, chat_id: str, conditions: list | None = None):
+    return Filter(must=[
+        FieldCondition(key="user_id", match=MatchValue(value=user_id)),
+        FieldCondition(key="chat_id", match=MatchValue(value=chat_id)),
+        *(conditions or []),
+    ])
+
+def quantization_config():
+    # quantized copies always stay in RAM, so on-disk originals are only read for rescoring
+    if quantization == "scalar":
+        return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True))
+    if quantization == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    return None
+
+def vectors_config():
+    params = qdrant.get_fastembed_vector_params()
+    return {name: config.model_copy(update={"on_disk": vectors_on_disk}) for name, config in params.items()}
+
+def search_params():
+    if quantization_config() is None:
+        return None
+    return SearchParams(quantization=QuantizationSearchParams(rescore=rescore, oversampling=oversampling))
+
+def ensure_collection(collection_name: str):
+    if not qdrant.collection_exists(collection_name):
+        qdrant.create_collection(
+            collection_name,
+            vectors_config=vectors_config(),
+            quantization_config=quantization_config(),
+            hnsw_config=HnswConfigDiff(on_disk=hnsw_on_disk),
+        )
+
+def setup_blocking():
+    ensure_collection(shared_collection)
+    qdrant.create_payload_index(shared_collection, "user_id", field_schema=KeywordIndexParams(type="keyword"))
+    qdrant.create_payload_index(shared_collection, "chat_id", field_schema=KeywordIndexParams(type="keyword", is_tenant=True))
+    qdrant.create_payload_index(shared_collection, "kind", field_schema=PayloadSchemaType.KEYWORD)
+    qdrant.create_payload_index(shared_collection, "aid", field_schema=PayloadSchemaType.INTEGER)
+
+def upsert(collection_name: str, points: list):
+    ensure_collection(collection_name)
+    qdrant.upsert(collection_name, points=points, wait=True)
+
+async def add_documents(user_id: str, chat_id: str, kind: str, documents: list, ids: list | None = None):
+    ids = ids or [str(uuid.uuid4()) for _ in documents]
+    vectors = await embedding.embed(documents)
+    vector_name = qdrant.get_vector_field_name()
+    points = []
+    for point_id, document, vector in zip(ids, documents, vectors):
+        payload = {"document": document}
+        if is_shared():
+            payload.update({"user_id": user_id, "chat_id": chat_id, "kind": kind})
+        points.append(PointStruct(id=point_id, vector={vector_name: vector}, payload=payload))
+    await asyncio.to_thread(upsert, collection_for(user_id, chat_id, kind), points)
+    return ids
+
+async def set_aid(user_id: str, chat_id: str, kind: str, point_id: str, aid: int):
+    await asyncio.to_thread(
+        qdrant.set_payload,
+        collection_for(user_id, chat_id, kind),
+        payload={"aid": aid},
+        points=[point_id],
+    )
+
+def query_points(user_id: str, chat_id: str, vector: list, limit: int, score_threshold: float | None = None, with_vectors: bool = False):
+    collection_name = collection_for(user_id, chat_id, HISTORY)
+    if not qdrant.collection_exists(collection_name):
+        return []
+    return qdrant.query_points(
+        collection_name,
+        query=vector,
+        using=qdrant.get_vector_field_name(),
+        query_filter=tenant_filter(user_id, chat_id) if is_shared() else None,
+        search_params=search_params(),
+        score_threshold=score_threshold,
+        limit=limit,
+        with_payload=True,
+        with_vectors=with_vectors,
+    ).points
+
+async def search(user_id: str, chat_id: str, query_text: str, limit: int, score_threshold: float | None = None, with_vectors: bool = False):
+    vector = (await embedding.embed([query_text]))[0]
+    return await asyncio.to_thread(query_points, user_id, chat_id, vector, limit, score_threshold, with_vectors)
+
+def delete_points_blocking(user_id: str, chat_id: str, kind: str, point_ids: list):
+    collection_name = collection_for(user_id, chat_id, kind)
+    if is_shared():
+        selector = FilterSelector(filter=tenant_filter(user_id, chat_id, [HasIdCondition(has_id=point_ids)]))
+    else:
+        selector = point_ids
+    qdrant.delete(collection_name=collection_name, points_selector=selector, wait=True)
+
+async def delete_points(user_id: str, chat_id: str, kind: str, point_ids: list):
+    await asyncio.to_thread(delete_points_blocking, user_id, chat_id, kind, point_ids)
+
+def delete_chat_blocking(user_id: str, chat_id: str):
+    if is_shared():
+        qdrant.delete(
+            collection_name=shared_collection,
+            points_selector=FilterSelector(filter=tenant_filter(user_id, chat_id)),
+            wait=True,
+        )
+        return
+    qdrant.delete_collection(collection_for(user_id, chat_id, HISTORY))
+
+async def delete_chat(user_id: str, chat_id: str):
+    await asyncio.to_thread(delete_chat_blocking, user_id, chat_id)
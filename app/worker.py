@@ -0,0 +1,65 @@
+import asyncio
+import os
+
+from prometheus_client import start_http_server
+from redis.asyncio import Redis as AsyncRedis
+
+from . import jobs, storage, summary, llm, vectors, embedding, turns, backends, archive
+
+purge_interval = float(os.getenv('APPLIED_JOBS_PURGE_INTERVAL', '3600'))
+
+# handlers run on the consumer loop, a blocking client would stall every stream while it waits
+async_redis = AsyncRedis(host="redis", port=6379, db=0, decode_responses=True)
+
+@jobs.handler("history")
+async def update_history_dbs(job_id: str, user_id: str, chat_id: str, action: str, result: str, previous_response: str, token: int | None = None):
+    # every step can be replayed: the point id is the job id, so qdrant overwrites instead of duplicating,
+    # and the message insert is keyed on the job id
+    await vectors.add_documents(
+        user_id,
+        chat_id,
+        vectors.HISTORY,
+        [previous_response + "\n\n" + action + "\n\n" + result],
+        [job_id],
+    )
+    aid = await storage.add_messages(user_id, chat_id, [("user", action), ("agent", result)], job_id)
+    # touched while the turn still holds the chat, so the archiver cannot pick it up in between
+    await archive.touch(user_id, chat_id)
+    if token is not None:
+        # the turn is committed, the next one may start; a replay releases nothing once the token changed
+        await asyncio.to_thread(turns.release, user_id, chat_id, token)
+    await vectors.set_aid(user_id, chat_id, vectors.HISTORY, job_id, aid)
+
+@jobs.handler("summary")
+async def update_summaries(job_id: str, user_id: str, chat_id: str):
+    await summary.update_summaries(async_redis, user_id, chat_id)
+
+@jobs.handler("release")
+async def release_chat(job_id: str, user_id: str, chat_id: str, token: int | None = None):
+    # turns now release from the history job, this only drains release jobs enqueued by older versions
+    if token is not None:
+        await asyncio.to_thread(turns.release, user_id, chat_id, token)
+
+async def purge_applied_jobs():
+    # replays happen within the done-marker ttl, older insert records are not needed anymore
+    while True:
+        try:
+            await storage.purge_applied_jobs(jobs.done_ttl)
+        except Exception as e:
+            print(f"purging applied jobs failed: {e}")
+        await asyncio.sleep(purge_interval)
+
+async def main():
+    start_http_server(int(os.getenv('WORKER_METRICS_PORT', '9100')))
+    backends.start_health_checks()
+    asyncio.create_task(purge_applied_jobs())
+    if archive.archive_interval > 0:
+        asyncio.create_task(archive.run_periodically())
+    try:
+        await jobs.run_worker(async_redis)
+    finally:
+        await llm.close()
+        await embedding.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
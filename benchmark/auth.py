@@ -0,0 +1,47 @@
+import argparse
+import json
+import os
+import time
+import uuid
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from app import functions
+
+def measure(function, token: str, iterations: int):
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        function(token)
+    return (time.perf_counter() - start_time) / iterations * 1_000_000
+
+def uncached(token: str):
+    functions.jwt_cache.clear()
+    return functions.user_id_from_jwt(token)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-request authentication cost of user_id_from_jwt.")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--output", default="auth-benchmark.json")
+    args = parser.parse_args()
+
+    if "EdDSA" not in functions.verifying_keys:
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        functions.signing_keys["EdDSA"] = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        functions.verifying_keys["EdDSA"] = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+    results = {}
+    for algorithm in ["RS256", "EdDSA"]:
+        functions.jwt_algorithm = algorithm
+        token = functions.user_id_to_jwt(str(uuid.uuid4()))
+        results[f"{algorithm}-verify_us"] = measure(uncached, token, args.iterations)
+        functions.user_id_from_jwt(token)
+        results[f"{algorithm}-cached_us"] = measure(functions.user_id_from_jwt, token, args.iterations)
+    results["cpu_count"] = os.cpu_count()
+    print(json.dumps(results, indent=2))
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
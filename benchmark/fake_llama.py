@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+tokens_per_second = float(os.getenv('FAKE_LLAMA_TOKENS_PER_SECOND', '20'))
+prompt_tokens_per_second = float(os.getenv('FAKE_LLAMA_PROMPT_TOKENS_PER_SECOND', '400'))
+latency_ms = float(os.getenv('FAKE_LLAMA_LATENCY_MS', '50'))
+completion_tokens = int(os.getenv('FAKE_LLAMA_COMPLETION_TOKENS', '120'))
+slots = int(os.getenv('FAKE_LLAMA_SLOTS', '1'))
+chars_per_token = 3.5
+
+WORDS = ["the", "elf", "gate", "warden", "coin", "ship", "rain", "inn", "dwarf", "night", "looks", "asks", "slowly",
+         "quietly", "smiles", "sword", "shadow", "harbour", "captain", "map", "old", "world", "and", "while", "a"]
+
+app = FastAPI(title="Fake llama.cpp")
+slot_locks = [asyncio.Lock() for _ in range(slots)]
+# per slot prompt cache: the previous prompt, so a request sharing its prefix only "evaluates" the rest
+slot_prompts = [""] * slots
+
+def prompt_text(messages: list):
+    return "".join(f"<|{message.get('role')}|>{message.get('content') or ''}" for message in messages)
+
+def common_prefix(a: str, b: str):
+    length = min(len(a), len(b))
+    for index in range(length):
+        if a[index] != b[index]:
+            return index
+    return length
+
+def completion_tokens_for(body: dict):
+    if body.get("response_format", {}).get("type") == "json_object":
+        text = " ".join(random.choice(WORDS) for _ in range(completion_tokens // 3))
+        return [json.dumps({"short": text, "medium": text, "long": text})]
+    count = min(completion_tokens, int(body.get("max_tokens") or completion_tokens))
+    return [random.choice(WORDS) + " " for _ in range(count)]
+
+async def evaluate_prompt(slot: int, body: dict):
+    prompt = prompt_text(body.get("messages", []))
+    cached = 0
+    if body.get("cache_prompt"):
+        cached = int(common_prefix(slot_prompts[slot], prompt) / chars_per_token)
+    slot_prompts[slot] = prompt
+    total = int(len(prompt) / chars_per_token)
+    evaluated = max(total - cached, 1)
+    prompt_seconds = evaluated / prompt_tokens_per_second
+    await asyncio.sleep(latency_ms / 1000 + prompt_seconds)
+    return cached, evaluated, prompt_seconds
+
+def timings(cached: int, evaluated: int, prompt_seconds: float, predicted: int, predicted_seconds: float):
+    return {
+        "cache_n": cached,
+        "prompt_n": evaluated,
+        "prompt_ms": prompt_seconds * 1000,
+        "prompt_per_second": evaluated / prompt_seconds if prompt_seconds else 0,
+        "predicted_n": predicted,
+        "predicted_ms": predicted_seconds * 1000,
+        "predicted_per_second": predicted / predicted_seconds if predicted_seconds else 0,
+    }
+
+def chunk(completion_id: str, model: str, delta: dict, finish_reason: str | None = None, **extra):
+    return "data: " + json.dumps({
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        **extra,
+    }) + "\n\n"
+
+def slot_for(body: dict):
+    if "id_slot" in body and 0 <= int(body["id_slot"]) < slots:
+        return int(body["id_slot"])
+    return min(range(slots), key=lambda slot: slot_locks[slot].locked())
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.post("/tokenize")
+async def tokenize(request: Request):
+    body = await request.json()
+    content = body.get("content", "")
+    size = max(1, int(chars_per_token))
+    pieces = [content[start:start + size] for start in range(0, len(content), size)]
+    if body.get("with_pieces"):
+        return {"tokens": [{"id": index, "piece": piece} for index, piece in enumerate(pieces)]}
+    return {"tokens": list(range(len(pieces)))}
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "fake", "object": "model"}]}
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model") or "fake"
+    completion_id = f"chatcmpl-{uuid.uuid4()}"
+    slot = slot_for(body)
+    tokens = completion_tokens_for(body)
+
+    if not body.get("stream"):
+        async with slot_locks[slot]:
+            cached, evaluated, prompt_seconds = await evaluate_prompt(slot, body)
+            predicted_seconds = len(tokens) / tokens_per_second
+            await asyncio.sleep(predicted_seconds)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": cached + evaluated, "completion_tokens": len(tokens), "total_tokens": cached + evaluated + len(tokens)},
+            "timings": timings(cached, evaluated, prompt_seconds, len(tokens), predicted_seconds),
+        }
+
+    async def events():
+        async with slot_locks[slot]:
+            cached, evaluated, prompt_seconds = await evaluate_prompt(slot, body)
+            yield chunk(completion_id, model, {"role": "assistant"})
+            start_time = time.time()
+            for token in tokens:
+                await asyncio.sleep(1 / tokens_per_second)
+                yield chunk(completion_id, model, {"content": token})
+            predicted_seconds = time.time() - start_time
+        yield chunk(
+            completion_id,
+            model,
+            {},
+            "stop",
+            timings=timings(cached, evaluated, prompt_seconds, len(tokens), predicted_seconds)
+        )
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stand-in for the llama.cpp server with a configurable token rate.")
+    parser.add_argument("--port", type=int, default=int(os.getenv('FAKE_LLAMA_PORT', '8000')))
+    args = parser.parse_args()
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
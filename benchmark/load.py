@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import time
+
+import httpx
+import yaml
+from prometheus_client.parser import text_string_to_metric_families
+
+from .quantization import chat_turn
+
+CHARACTER_TEMPLATE = os.path.join(os.path.dirname(__file__), "..", "ui", "public", "char-template.yaml")
+
+# histograms whose sum/count deltas make up the per-stage breakdown of a run
+STAGE_METRICS = {
+    "app_context_stage_duration_seconds": "source",
+    "app_context_duration_seconds": None,
+    "app_llm_prompt_eval_seconds": None,
+    "app_llm_generation_seconds": None,
+    "app_llm_time_to_first_token_seconds": None,
+    "app_llm_request_duration_seconds": "mode",
+    "app_job_lag_seconds": "type",
+    "app_job_duration_seconds": "type",
+}
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.busy = 0
+
+    def observe(self, step: str, seconds: float):
+        self.latencies.setdefault(step, []).append(seconds)
+
+    def error(self, step: str, reason: str):
+        self.errors.setdefault(step, {})
+        self.errors[step][reason] = self.errors[step].get(reason, 0) + 1
+
+def percentile(values: list, q: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def summarize(values: list):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "mean": sum(values) / len(values),
+        "max": max(values),
+    }
+
+async def scrape(client: httpx.AsyncClient, url: str | None):
+    if not url:
+        return {}
+    try:
+        response = await client.get(url)
+    except httpx.HTTPError as e:
+        print(f"could not scrape {url}: {e}")
+        return {}
+    totals = {}
+    for family in text_string_to_metric_families(response.text):
+        if family.name not in STAGE_METRICS:
+            continue
+        label = STAGE_METRICS[family.name]
+        for sample in family.samples:
+            if not sample.name.endswith(("_sum", "_count")):
+                continue
+            key = (family.name, sample.labels.get(label, "all") if label else "all", sample.name.rsplit("_", 1)[1])
+            totals[key] = totals.get(key, 0) + sample.value
+    return totals
+
+def stage_breakdown(before: dict, after: dict):
+    stages = {}
+    for (metric, label, kind), value in after.items():
+        if kind != "count":
+            continue
+        count = value - before.get((metric, label, "count"), 0)
+        if count <= 0:
+            continue
+        seconds = after.get((metric, label, "sum"), 0) - before.get((metric, label, "sum"), 0)
+        stages.setdefault(metric, {})[label] = {"count": count, "mean": seconds / count}
+    return stages
+
+async def timed_request(client: httpx.AsyncClient, recorder: Recorder, step: str, method: str, url: str, **kwargs):
+    start_time = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError as e:
+        recorder.error(step, type(e).__name__)
+        return None
+    recorder.observe(step, time.perf_counter() - start_time)
+    if response.status_code != 200:
+        recorder.error(step, f"{response.status_code}")
+        return None
+    body = response.json()
+    if isinstance(body, dict) and "error" in body and step != "turn":
+        recorder.error(step, f"{body['error']}")
+        return None
+    return response
+
+async def streamed_turn(client: httpx.AsyncClient, recorder: Recorder, chat_id: str, description: str):
+    start_time = time.perf_counter()
+    first_token = None
+    event = None
+    data = {"error": "empty stream"}
+    try:
+        async with client.stream(
+            "POST",
+            f"/chat/{chat_id}",
+            json={"description": description},
+            headers={"Accept": "text/event-stream"}
+        ) as response:
+            if response.headers.get("content-type", "").startswith("application/json"):
+                return json.loads(await response.aread())
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[5:])
+                    if event is None and first_token is None:
+                        first_token = time.perf_counter() - start_time
+                    if event in ("done", "error"):
+                        break
+                    event = None
+    except httpx.HTTPError as e:
+        recorder.error("turn", type(e).__name__)
+        return {"error": type(e).__name__}
+    if event == "error":
+        return data
+    recorder.observe("turn", time.perf_counter() - start_time)
+    if first_token is not None:
+        recorder.observe("turn_first_token", first_token)
+    return data
+
+async def blocking_turn(client: httpx.AsyncClient, recorder: Recorder, chat_id: str, description: str):
+    start_time = time.perf_counter()
+    try:
+        response = await client.post(f"/chat/{chat_id}", json={"description": description})
+    except httpx.HTTPError as e:
+        recorder.error("turn", type(e).__name__)
+        return {"error": type(e).__name__}
+    body = response.json()
+    if "error" not in body:
+        recorder.observe("turn", time.perf_counter() - start_time)
+    return body
+
+async def simulate_user(base_url: str, args, character: dict, recorder: Recorder, rng: random.Random):
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as client:
+        response = await timed_request(client, recorder, "register", "POST", "/register", json={"password": args.password})
+        if response is None:
+            return
+        # the session cookie is marked secure, so it has to be sent by hand over plain http
+        client.headers["Cookie"] = f"user_jwt={response.cookies.get('user_jwt')}"
+        response = await timed_request(client, recorder, "new_chat", "GET", "/new")
+        if response is None:
+            return
+        chat_id = response.json()["chat"]
+        for _ in range(args.characters):
+            await timed_request(client, recorder, "add_character", "POST", f"/chat/{chat_id}/characters", json=character)
+        turns = 0
+        while turns < args.turns:
+            if args.stream:
+                body = await streamed_turn(client, recorder, chat_id, chat_turn(rng))
+            else:
+                body = await blocking_turn(client, recorder, chat_id, chat_turn(rng))
+            if body.get("error") == "Chat is already active.":
+                recorder.busy += 1
+                await asyncio.sleep(args.busy_wait)
+                continue
+            if "error" in body:
+                recorder.error("turn", f"{body['error']}")
+            turns += 1
+            await asyncio.sleep(args.think_time * rng.random())
+        await timed_request(client, recorder, "history", "GET", f"/chat/{chat_id}", params={"limit": 50})
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def main(args):
+    with open(CHARACTER_TEMPLATE) as template:
+        character = yaml.safe_load(template)
+    recorder = Recorder()
+    async with httpx.AsyncClient(timeout=10) as metrics_client:
+        before_app = await scrape(metrics_client, args.metrics_url or args.base_url + "/metrics/")
+        before_worker = await scrape(metrics_client, args.worker_metrics_url)
+        start_time = time.perf_counter()
+        await asyncio.gather(*[
+            simulate_user(args.base_url, args, character, recorder, random.Random(args.seed + user))
+            for user in range(args.users)
+        ])
+        duration = time.perf_counter() - start_time
+        # give the worker a moment to drain the follow-up jobs of the last turns
+        await asyncio.sleep(args.drain)
+        after_app = await scrape(metrics_client, args.metrics_url or args.base_url + "/metrics/")
+        after_worker = await scrape(metrics_client, args.worker_metrics_url)
+
+    results = {
+        "commit": git_commit(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "users": args.users,
+            "turns": args.turns,
+            "characters": args.characters,
+            "stream": args.stream,
+            "think_time": args.think_time,
+        },
+        "duration_seconds": duration,
+        "throughput": {
+            "turns_per_second": len(recorder.latencies.get("turn", [])) / duration,
+            "requests_per_second": sum(len(values) for values in recorder.latencies.values() if values) / duration,
+        },
+        "latency_seconds": {step: summarize(values) for step, values in recorder.latencies.items() if values},
+        "busy_retries": recorder.busy,
+        "errors": recorder.errors,
+        "stages": {**stage_breakdown(before_app, after_app), **stage_breakdown(before_worker, after_worker)},
+    }
+    print(json.dumps(results, indent=2))
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate concurrent users playing chats against a running app.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8080/api/v1")
+    parser.add_argument("--metrics-url", default=None, help="defaults to <base-url>/metrics/")
+    parser.add_argument("--worker-metrics-url", default="http://127.0.0.1:9100/")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--characters", type=int, default=2)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--think-time", type=float, default=1, help="maximum random pause between turns in seconds")
+    parser.add_argument("--busy-wait", type=float, default=0.5)
+    parser.add_argument("--drain", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--password", default="benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="load-benchmark.json")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,120 @@
+import argparse
+import json
+import random
+import time
+
+import numpy
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointStruct, VectorParams, Distance, ScalarQuantization, \
+    ScalarQuantizationConfig, ScalarType, BinaryQuantization, BinaryQuantizationConfig, SearchParams, \
+    QuantizationSearchParams, HnswConfigDiff
+
+CHARACTERS = ["Grimek", "Lienne", "Idrinth", "the innkeeper", "a gate warden", "the ship captain", "an old loremaster"]
+PLACES = ["the Dancing Ogre", "the northern gate of Lothern", "the harbour", "Duskhollow", "the forest road", "the archive"]
+ACTIONS = ["asks about", "argues over", "bargains for", "searches for", "hides", "remembers", "fights for", "sings about"]
+OBJECTS = ["a room for the night", "the last coin", "a forged travel pass", "a map of Ulthuan", "an old grudge",
+           "a cursed blade", "passage to the old world", "the missing handmaiden"]
+MOODS = ["nervously", "drunkenly", "with quiet anger", "cheerfully", "while the rain gets heavier", "at dusk"]
+
+OPTIONS = {
+    "float32-ram": {},
+    "float32-disk": {"on_disk": True},
+    "scalar-ram": {"quantization": "scalar"},
+    "scalar-disk-rescore": {"quantization": "scalar", "on_disk": True, "rescore": True},
+    "scalar-disk": {"quantization": "scalar", "on_disk": True, "rescore": False},
+    "binary-disk-rescore": {"quantization": "binary", "on_disk": True, "rescore": True},
+    "binary-disk": {"quantization": "binary", "on_disk": True, "rescore": False},
+}
+
+def chat_turn(rng: random.Random):
+    sentences = []
+    for _ in range(rng.randint(2, 5)):
+        sentences.append(f"{rng.choice(CHARACTERS)} {rng.choice(ACTIONS)} {rng.choice(OBJECTS)} at {rng.choice(PLACES)} {rng.choice(MOODS)}.")
+    return " ".join(sentences)
+
+def embed_corpus(texts: list, random_vectors: bool, dimensions: int, seed: int):
+    if random_vectors:
+        vectors = numpy.random.default_rng(seed).normal(size=(len(texts), dimensions)).astype(numpy.float32)
+    else:
+        from fastembed import TextEmbedding
+        vectors = numpy.array(list(TextEmbedding("BAAI/bge-small-en").embed(texts)), dtype=numpy.float32)
+    return vectors / numpy.linalg.norm(vectors, axis=1, keepdims=True)
+
+def quantization_config(option: dict):
+    if option.get("quantization") == "scalar":
+        return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True))
+    if option.get("quantization") == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    return None
+
+def search_params(option: dict, oversampling: float):
+    if option.get("quantization") is None:
+        return None
+    return SearchParams(quantization=QuantizationSearchParams(rescore=option.get("rescore", True), oversampling=oversampling))
+
+def wait_for_index(client: QdrantClient, collection_name: str):
+    while client.get_collection(collection_name).status != "green":
+        time.sleep(0.5)
+
+def benchmark_option(client: QdrantClient, name: str, option: dict, corpus, queries, truth, batch_size: int, oversampling: float):
+    collection_name = f"benchmark-{name}"
+    if client.collection_exists(collection_name):
+        client.delete_collection(collection_name)
+    client.create_collection(
+        collection_name,
+        vectors_config=VectorParams(size=corpus.shape[1], distance=Distance.COSINE, on_disk=option.get("on_disk", False)),
+        quantization_config=quantization_config(option),
+        hnsw_config=HnswConfigDiff(on_disk=option.get("on_disk", False)),
+    )
+    for start in range(0, len(corpus), batch_size):
+        client.upsert(
+            collection_name,
+            points=[PointStruct(id=i, vector=corpus[i].tolist()) for i in range(start, min(start + batch_size, len(corpus)))],
+            wait=True,
+        )
+    wait_for_index(client, collection_name)
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start_time = time.perf_counter()
+        points = client.query_points(collection_name, query=query.tolist(), limit=10, search_params=search_params(option, oversampling)).points
+        latencies.append(time.perf_counter() - start_time)
+        hits += len({point.id for point in points} & expected)
+    client.delete_collection(collection_name)
+    latencies.sort()
+    return {
+        "option": name,
+        "recall@10": hits / (10 * len(queries)),
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure recall@10 and query latency of Qdrant storage options on synthetic chat turns.")
+    parser.add_argument("--qdrant", default="http://qdrant:6333")
+    parser.add_argument("--turns", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--oversampling", type=float, default=2.0)
+    parser.add_argument("--random-vectors", action="store_true", help="use random unit vectors instead of fastembed")
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--options", nargs="*", default=list(OPTIONS), choices=list(OPTIONS))
+    parser.add_argument("--output", default="quantization-benchmark.json")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [chat_turn(rng) for _ in range(args.turns + args.queries)]
+    vectors = embed_corpus(texts, args.random_vectors, args.dimensions, args.seed)
+    corpus, queries = vectors[:args.turns], vectors[args.turns:]
+    truth = [set(numpy.argsort(-corpus @ query)[:10].tolist()) for query in queries]
+
+    client = QdrantClient(args.qdrant)
+    results = []
+    for name in args.options:
+        result = benchmark_option(client, name, OPTIONS[name], corpus, queries, truth, args.batch_size, args.oversampling)
+        print(json.dumps(result))
+        results.append(result)
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)